@@ -0,0 +1,460 @@
+#!/usr/bin/env python
+'''
+Benchmarks for GhettoNet.
+
+This generates a synthetic corpus (in the GhettoNet format) for each of the
+given sizes and then times the main stages of the program - parsing,
+merging (both the default merge and each stage of the merge_names
+pipeline), writing, updating a hosts file, and answering DNS queries - so
+that scaling can be checked (the time per entry should stay roughly 
+constant).  The layout stage compares the time a resolver that searches
+the hosts file line by line takes to find names (used with a Zipf
+distribution) in the default layout and in layouts from Layout.  The 
+startup stage times (the fastest of several) complete runs of the command
+line for common, small invocations - listing a hosts file, an update that
+leaves it unchanged, and so on - where the time is mostly spent starting 
+Python and importing modules.  For example:
+
+  ./bench.py 1000 10000 100000 1000000 10000000
+  ./bench.py --stages parse,merge --json 100000 >> results.json
+  ./bench.py --stages startup --launcher old/ghettonet.py 1000
+
+Each stage runs in a separate process, so that the peak memory use (which
+includes the parsed entries that the stage needs) can be measured too.
+With --json the results are printed one JSON object per line, for
+comparison between versions (--launcher gives the script run by the startup
+stage, so that an older version can be timed too).
+
+The corpus is tunable: the number of names per entry, the fraction of
+entries that repeat the names of an earlier entry (with a later date, with
+the same date and address, or with the same date and a different address -
+a conflict), the fraction of comments that are duplicated, and the
+fraction of blocks that are marked up as HTML.
+'''
+
+
+from bisect import bisect
+from cStringIO import StringIO
+from json import dumps, loads
+from multiprocessing import Process
+from optparse import OptionParser
+from os import remove, close, devnull
+from os.path import join, dirname, abspath
+from random import Random
+from resource import getrusage, RUSAGE_SELF
+from shutil import rmtree
+from socket import socket, AF_INET, SOCK_DGRAM, timeout as socket_timeout
+from subprocess import Popen, PIPE, call
+from sys import executable, stdout
+from tempfile import mkstemp, mkdtemp
+from time import time
+
+from ghettonet.core import scan, set_stderr
+from ghettonet.merging import merge, merge_by_date, merge_same_ipv4, \
+    merge_force, without_gc
+from ghettonet.hosts import write, update_hosts, BackupStore, Layout
+from ghettonet.dns import DnsResponder, dns_query
+
+
+STAGES = ['parse', 'merge', 'pipeline', 'write', 'update_hosts', 'dns', 
+          'layout', 'startup']
+
+# the command line timed by the startup stage
+LAUNCHER = join(dirname(abspath(__file__)), 'ghettonet.py')
+
+# the number of times each invocation is run by the startup stage (the 
+# fastest is reported)
+STARTUPS = 10
+
+# the number of DNS queries timed, and the number sent before waiting for
+# the responses
+QUERIES = 100000
+WINDOW = 32
+
+# the number of names looked up in each hosts file layout
+LOOKUPS = 100
+
+
+def corpus(count, names=3, repeats=0.1, collisions=0.05, conflicts=0.01,
+           comments=0.5, html=0.2, seed=0):
+    '''
+    Generate the lines of a corpus of count entries, each with the given
+    number of names, in blocks of up to 100 entries with text in between.
+
+    Fractions of the entries repeat the names of an earlier entry with a
+    later date (repeats), with the same date and address (collisions), or
+    with the same date and a different address (conflicts).  A fraction
+    (comments) of the comments are taken from a small set, so are
+    duplicated, and a fraction (html) of the blocks are marked up.
+    '''
+    random = Random(seed)
+    history = []
+    start = 0
+    while start < count:
+        if random.random() < html:
+            (before, after) = ('<p>', '</p>')
+        else:
+            (before, after) = ('', '')
+        yield 'Some text before the block.'
+        yield before + '### BEGIN GHETTONET' + after
+        for index in xrange(start, min(count, start + 100)):
+            ipv4 = '10.%d.%d.%d' % (index >> 16 & 255, index >> 8 & 255,
+                                    index & 255)
+            entry_names = ['host%d-%d.example.org' % (index, offset)
+                           for offset in range(names)]
+            date = '%04d-%02d-%02d %02d:%02d' % (
+                2000 + index // 100000, 1 + index // 10000 % 10,
+                1 + index // 400 % 25, index // 60 % 24, index % 60)
+            choice = random.random()
+            if history and choice < repeats + collisions + conflicts:
+                (old_ipv4, entry_names, old_date) = random.choice(history)
+                if choice >= repeats:
+                    date = old_date
+                    if choice < repeats + collisions:
+                        ipv4 = old_ipv4
+            history.append((ipv4, entry_names, date))
+            if len(history) > 1000:
+                history.pop(random.randrange(len(history)))
+            if random.random() < comments:
+                yield before + '# from feed %d' % (index % 10) + after
+            else:
+                yield before + '# entry %d' % index + after
+            yield before + '## DATE ' + date + after
+            yield before + '%s    %s' % (ipv4, ' '.join(entry_names)) + after
+            yield ''
+        start = start + 100
+        yield before + '### END GHETTONET' + after
+
+
+def write_corpus(count, **kargs):
+    '''
+    Write a corpus to a temporary file, returning (path, lines, bytes).
+    '''
+    (handle, path) = mkstemp(suffix='.txt')
+    close(handle)
+    out = open(path, 'w')
+    (lines, size) = (0, 0)
+    try:
+        for line in corpus(count, **kargs):
+            out.write(line + '\n')
+            (lines, size) = (lines + 1, size + len(line) + 1)
+    finally:
+        out.close()
+    return (path, lines, size)
+
+
+def parsed(path):
+    '''
+    The entries in the file at path (parsed as in a normal run, with the
+    garbage collector disabled).
+    '''
+    source = open(path)
+    try:
+        return without_gc(list, scan(source))
+    finally:
+        source.close()
+
+
+def timed_stage(function, times):
+    '''
+    Wrap a merge_names function so that the total time spent in it is
+    added to times.
+    '''
+    def timed(entries, quiet):
+        start = time()
+        try:
+            return function(entries, quiet)
+        finally:
+            times[function.__name__] = \
+                times.get(function.__name__, 0) + time() - start
+    return timed
+
+
+def query_rate(entries, seed=0):
+    '''
+    Serve the entries from a DnsResponder in a separate process and time 
+    QUERIES queries (one in ten for an unknown name), returning (seconds
+    to load, seconds for the queries, number of queries not answered).
+    '''
+    start = time()
+    responder = DnsResponder(entries, address=('127.0.0.1', 0))
+    load = time() - start
+    server = Process(target=responder.serve_forever)
+    server.start()
+    try:
+        random = Random(seed)
+        names = [name for entry in entries for name in entry.names]
+        queries = []
+        for index in xrange(QUERIES):
+            if index % 10:
+                name = random.choice(names)
+            else:
+                name = 'unknown%d.example.com' % index
+            queries.append(dns_query(name, id=index & 0xffff))
+        client = socket(AF_INET, SOCK_DGRAM)
+        client.settimeout(1)
+        lost = 0
+        start = time()
+        for offset in xrange(0, QUERIES, WINDOW):
+            window = queries[offset:offset+WINDOW]
+            for query in window:
+                client.sendto(query, responder.address)
+            for query in window:
+                try:
+                    client.recv(4096)
+                except socket_timeout:
+                    lost = lost + 1
+                    break
+        return (load, time() - start, lost)
+    finally:
+        server.terminate()
+        server.join()
+
+
+def lookup_time(text, names):
+    '''
+    The time taken to find each name in the hosts file text by reading the
+    lines in turn until the name is found, as resolvers that read the 
+    hosts file (glibc's "files", for example) do.
+    '''
+    lines = text.splitlines()
+    start = time()
+    for name in names:
+        for line in lines:
+            if line[:1] != '#' and name in line.split()[1:]:
+                break
+    return time() - start
+
+
+def layouts(entries, seed=0):
+    '''
+    Compare the time to look up LOOKUPS names (where the name with rank r
+    is used in proportion to 1/r) in the default layout and in layouts
+    ordered by IPv4 and by hits, returning a list of (name, seconds).
+    '''
+    random = Random(seed)
+    names = [name for entry in entries for name in entry.names]
+    random.shuffle(names)
+    hits = dict((name, int(1e6 / rank))
+                for (rank, name) in enumerate(names, 1))
+    (totals, total) = ([], 0)
+    for name in names:
+        total = total + hits[name]
+        totals.append(total)
+    lookups = [names[bisect(totals, random.random() * total)] 
+               for index in xrange(LOOKUPS)]
+    results = []
+    for (name, layout) in [('lookup_default', None),
+                           ('lookup_ipv4', Layout(order='ipv4')),
+                           ('lookup_hits', Layout(order='hits', hits=hits)),
+                           ('lookup_hits_4', Layout(order='hits', hits=hits,
+                                                    per_line=4))]:
+        out = StringIO()
+        write(out, entries, layout=layout)
+        results.append((name, lookup_time(out.getvalue(), lookups)))
+    return results
+
+
+def startup_times(launcher=LAUNCHER, runs=STARTUPS):
+    '''
+    The time for the fastest of runs invocations of the command line at
+    launcher, for each of several common (small) invocations, returning a 
+    list of (name, seconds).  The hosts file is a small corpus, written 
+    to a temporary directory (so that it can be updated).
+    '''
+    directory = mkdtemp()
+    try:
+        hosts = join(directory, 'hosts')
+        out = open(hosts, 'w')
+        try:
+            out.write('127.0.0.1 localhost\n')
+            for line in corpus(10):
+                out.write(line + '\n')
+        finally:
+            out.close()
+        invocations = [
+            ('startup_version', ['--version']),
+            ('startup_help', ['-h']),
+            ('startup_list', ['-p', hosts]),
+            ('startup_unchanged', ['-w', '-p', hosts]),
+            ('startup_input', ['-p', hosts, '-i', hosts])]
+        null = open(devnull, 'w')
+        try:
+            call([executable, launcher, '-w', '-p', hosts], stdout=null,
+                 stderr=null)
+            results = []
+            for (name, args) in invocations:
+                best = None
+                for run in xrange(runs):
+                    start = time()
+                    if call([executable, launcher] + args, stdout=null,
+                            stderr=null):
+                        raise Exception('%s failed' % ' '.join(args))
+                    seconds = time() - start
+                    if best is None or seconds < best:
+                        best = seconds
+                results.append((name, best))
+            return results
+        finally:
+            null.close()
+    finally:
+        rmtree(directory)
+
+
+def run_stage(stage, path, launcher=LAUNCHER):
+    '''
+    Run a single stage on the corpus at path, returning a list of
+    (name, seconds) pairs.  Messages from merging are discarded (merges
+    are not quiet, so that conflicts are resolved rather than raised).
+    '''
+    set_stderr(open(devnull, 'w'))
+    if stage == 'startup':
+        return startup_times(launcher=launcher)
+    elif stage == 'parse':
+        start = time()
+        parsed(path)
+        return [('parse', time() - start)]
+    entries = parsed(path)
+    if stage == 'merge':
+        start = time()
+        merge(entries, quiet=False)
+        return [('merge', time() - start)]
+    elif stage == 'pipeline':
+        times = {}
+        policy = [timed_stage(function, times) for function in
+                  (merge_by_date, merge_same_ipv4, merge_force)]
+        start = time()
+        without_gc(merge, entries, quiet=False, merge_names=policy)
+        total = time() - start
+        return [(name, times.get(name, 0)) for name in
+                ('merge_by_date', 'merge_same_ipv4', 'merge_force')] + \
+               [('pipeline', total)]
+    merged = merge(entries, quiet=False)
+    if stage == 'write':
+        out = open(devnull, 'w')
+        start = time()
+        write(out, merged)
+        out.close()
+        return [('write', time() - start)]
+    elif stage == 'update_hosts':
+        directory = mkdtemp()
+        try:
+            hosts = join(directory, 'hosts')
+            open(hosts, 'w').write('127.0.0.1 localhost\n')
+            backups = BackupStore(join(directory, 'backups'))
+            results = []
+            for name in ('update_hosts', 'update_hosts_unchanged'):
+                start = time()
+                update_hosts(merged, hosts_path=hosts, backups=backups)
+                results.append((name, time() - start))
+            return results
+        finally:
+            rmtree(directory)
+    elif stage == 'dns':
+        (load, seconds, lost) = query_rate(merged)
+        if lost:
+            raise Exception('%d DNS queries were not answered' % lost)
+        return [('dns_load', load), ('dns_queries', seconds)]
+    elif stage == 'layout':
+        return layouts(merged)
+    raise Exception('Unknown stage: %s' % stage)
+
+
+def child(stage, path, launcher=LAUNCHER):
+    '''
+    Run a stage in this (separate) process, printing the results, with
+    memory use, as JSON.
+    '''
+    base = getrusage(RUSAGE_SELF).ru_maxrss
+    results = run_stage(stage, path, launcher=launcher)
+    peak = getrusage(RUSAGE_SELF).ru_maxrss
+    print dumps({'results': results, 'base_kb': base, 'peak_kb': peak})
+
+
+def bench(sizes, stages, json=False, launcher=LAUNCHER, **kargs):
+    '''
+    Generate a corpus for each size and run the stages on it, printing
+    a table or (if json is True) JSON.
+    '''
+    if not json:
+        print '%-24s %10s %10s %10s %10s %10s' % (
+            'stage', 'entries', 'lines', 'seconds', 'us/entry', 'peak MB')
+    for size in sizes:
+        (path, lines, size_bytes) = write_corpus(size, **kargs)
+        try:
+            for stage in stages:
+                process = Popen([executable, __file__, '--child', 
+                                 '--launcher', launcher, stage, path], 
+                                stdout=PIPE)
+                output = process.communicate()[0]
+                if process.returncode:
+                    raise Exception('Stage %s failed for %d entries' %
+                                    (stage, size))
+                result = loads(output.splitlines()[-1])
+                for (name, seconds) in result['results']:
+                    if json:
+                        print dumps(dict(stage=name, entries=size,
+                                         lines=lines, bytes=size_bytes,
+                                         seconds=seconds,
+                                         base_kb=result['base_kb'],
+                                         peak_kb=result['peak_kb'],
+                                         parameters=kargs), sort_keys=True)
+                    else:
+                        print '%-24s %10d %10d %10.3f %10.2f %10.1f' % (
+                            name, size, lines, seconds, 1e6 * seconds / size,
+                            result['peak_kb'] / 1024.0)
+                    stdout.flush()
+        finally:
+            remove(path)
+
+
+def build_parser():
+    parser = OptionParser('''
+
+  %prog [options] [SIZE ...]
+
+Time the stages of GhettoNet on synthetic corpora of SIZE entries
+(default 1000 10000 100000).''')
+    parser.add_option('--stages', action='store', type='string',
+                      dest='stages', default=','.join(STAGES),
+                      help='comma separated stages (default %s)' %
+                      ','.join(STAGES))
+    parser.add_option('--json', action='store_true', default=False,
+                      dest='json', help='print results as JSON')
+    parser.add_option('--names', action='store', type='int', default=3,
+                      dest='names', help='names per entry (default 3)')
+    for (name, default, help) in [
+            ('repeats', 0.1, 'repeat names with a later date'),
+            ('collisions', 0.05, 'repeat names with the same date and '
+             'address'),
+            ('conflicts', 0.01, 'repeat names with the same date and a '
+             'different address'),
+            ('comments', 0.5, 'have duplicated comments'),
+            ('html', 0.2, 'are marked up as HTML (by block)')]:
+        parser.add_option('--' + name, action='store', type='float',
+                          default=default, dest=name, metavar='FRACTION',
+                          help='fraction of entries that %s (default %g)' %
+                          (help, default))
+    parser.add_option('--seed', action='store', type='int', default=0,
+                      dest='seed', help='random seed (default 0)')
+    parser.add_option('--launcher', action='store', type='string',
+                      default=LAUNCHER, dest='launcher', metavar='PATH',
+                      help='the command line timed by the startup stage '
+                      '(default %s)' % LAUNCHER)
+    parser.add_option('--child', action='store_true', default=False,
+                      dest='child', help='(internal) run a single stage')
+    return parser
+
+
+if __name__ == '__main__':
+    (options, args) = build_parser().parse_args()
+    if options.child:
+        child(*args, launcher=options.launcher)
+    else:
+        bench(map(int, args) or [1000, 10000, 100000],
+              options.stages.split(','), json=options.json,
+              launcher=abspath(options.launcher),
+              names=options.names, repeats=options.repeats,
+              collisions=options.collisions, conflicts=options.conflicts,
+              comments=options.comments, html=options.html,
+              seed=options.seed)
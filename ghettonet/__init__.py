@@ -0,0 +1,152 @@
+'''
+
+Welcome to GhettoNet!
+======================
+
+
+Introduction
+------------
+
+GhettoNet helps you see censored websites by adding their names to the "hosts"
+file on your computer.  It can pull updates from the web, or read them from a
+file (perhaps a saved email).  It can also print out the addresses you have so
+that you can send them to a friend.  And you can add or delete particular
+entries yourself.
+
+This initial version of GhettoNet is a "command line app".  That means that
+it must be run from a prompt, as a privileged user.  If you don't know what
+that means then you need more help - I can't explain everything here, but I
+hope that other people will, so please search on the Internet for advice.
+
+To see all the options available, run ghettonet.py with the "-h" argument.
+
+Requires Python 2.6 or later.
+
+
+File Format
+-----------
+
+GhettoNet data can be embedded in files a variety of formats.  A valid data
+block is detected by:
+o  splitting into lines based on (optional) carriage return and newline.
+o  looking for the begin line
+o  reading all data lines until the (optional) end line or bad data
+
+The EOL expression below is used to split lines:
+>>> EOL.split('a\\nb\\r\\nc')
+['a', 'b', 'c']
+
+
+More than one data block may be present in a file.
+
+A valid begin line looks like this:
+### BEGIN GHETTONET
+More exactly, see the BEGIN regular expression below, with the tests:
+>>> bool(BEGIN.match('### BEGIN GHETTONET'))
+True
+>>> bool(BEGIN.match('##beginghettonet'))
+True
+
+A valid end line looks like:
+### END GHETTONET
+or see the END regular expression below, with tests:
+>>> bool(END.match('### END GHETTONET'))
+True
+>>> bool(END.match('##endghettonet'))
+True
+
+
+A valid data line is one of:
+o  a comment, prefixed by #
+o  a blank line
+o  a date (simplified ISO 8601: yyyy-mm-dd hh:mm:ss) prefixed by ## DATE
+o  a valid IPv4 line (only, currently) for a hosts file 
+Any other data are taken to indicate the end of the block (if these don't
+match the end line then a warning is given; if we are parsing hosts then
+we refuse to continue).
+
+The DATE regular expression matches dates:
+>>> bool(DATE.match('## DATE 1967-05-19'))
+True
+>>> bool(DATE.match('## DATE 1967-05-19 10:12'))
+True
+>>> bool(DATE.match('## DATE 1967-05-19 10:12:45'))
+True
+>>> bool(DATE.match('### DATE 1967-05-19 10:12:45 - future expansion'))
+True
+>>> bool(DATE.match('## DATE 1967-05-19bad'))
+False
+>>> bool(POSSIBLE_DATE.match('## DATE 1967-05-19bad')) # used to warn user
+True
+
+
+The aim above is to define something that is easy for people to generate and
+send, and which can be stored directly in the hosts file, but which has a 
+low probability of causing errors.
+
+The date indicates when the information was known and is used to prioritise
+conflicting entries, if present (most recent date wins).
+
+
+Here is a complete example of a GhettoNet file:
+
+  ### BEGIN GHETTONET
+
+  # wikileaks.ch from DNS
+  ## DATE 2010-12-4
+  213.251.145.96    www.wikileaks.org wikileaks.org
+
+  ### END GHETTONET
+
+Note that indentation and blank lines are optional, as are the comment and 
+date.
+
+A feed can also be published as a delta - only the entries that changed
+since an earlier version (see the --delta option).  Names that were 
+dropped are given in an entry with the comment "## REMOVE":
+
+  ### BEGIN GHETTONET
+
+  ## REMOVE
+  ## DATE 2010-12-10
+  0.0.0.0    old.example.org
+
+  ### END GHETTONET
+
+which removes those names unless they have a later date elsewhere.  Older
+clients read this as an ordinary entry, sending the names nowhere.  The 
+--since option skips entries dated earlier than a given date, so that 
+parsing a large feed costs little when only recent changes are needed.
+
+The most important part of this program is the file format.  Please write new
+clients or design new ways of spreading this data - this is very much a proof
+of concept (and, I hope, a library others can build on).
+
+
+Modules
+-------
+
+The format itself (and parsing) is in ghettonet.core, whose main names are
+also available from this package.  The rest of the program is in 
+ghettonet.merging (merging and filtering entries), ghettonet.hosts (reading
+and updating hosts files), ghettonet.sources (the hosts file, local files
+and stdin), ghettonet.network (downloads), ghettonet.watch (--watch),
+ghettonet.dns (--dns), ghettonet.stats (--stats) and ghettonet.cli (the 
+command line).  The network, watch and DNS modules are only imported when
+they are used.
+
+
+Licence
+-------
+
+This code is placed into the public domain.  You can do whatever you want with
+it, but it comes with no warranty or guarantee.
+'''
+
+
+from ghettonet.core import EOL, BEGIN, END, DATE, POSSIBLE_DATE, IPV4, NAME, \
+    NAMES, ADDRESS, MARKER, CHUNK, COMPRESSIONS, ParseException, Entry, \
+    parse, Scanner, split, scan, decoded, CompressedOutput
+
+
+__VERSION__ = '0.0'
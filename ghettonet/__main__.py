@@ -0,0 +1,9 @@
+'''
+Run the command line interface with "python -m ghettonet".
+'''
+
+
+from ghettonet.cli import main
+
+
+main()
@@ -0,0 +1,504 @@
+'''
+The command line interface.
+'''
+
+
+from datetime import datetime
+from itertools import chain
+from optparse import OptionParser, OptionGroup
+from os.path import join
+from platform import system
+from sys import stdout, stderr
+
+from ghettonet import __VERSION__
+from ghettonet.core import COMPRESSIONS, CompressedOutput, Entry, PARSED
+from ghettonet.merging import AddressRanges, FilterPlan, NameIndex, delta, \
+    merge, read_addresses, split_removals, strip_comment
+from ghettonet.stats import Stats
+from ghettonet.hosts import BackupStore, DEFAULT_HOSTS, Layout, \
+    backup_directory, get_hosts_path, read_hits, update_hosts, write
+from ghettonet.sources import Snapshot, from_hosts, from_paths, from_stdin, \
+    ingest
+
+
+def build_parser():
+    '''
+    Construct the command line parser.  We use optparse rather than argparse
+    so that people with Python before 2.7 can use the script.
+    '''
+    parser = OptionParser('''
+
+  %prog [options]
+
+GhettoNet manages IPv4/DNS data in a format compatible with hosts files.
+
+The format can be easily embedded in files, emails and web pages:
+
+  ### BEGIN GHETTONET
+  213.251.145.96    www.wikileaks.org wikileaks.org
+  ### END GHETTONET
+
+By default, all inputs are combined and written to stdout.  Inputs are
+taken from the local hosts file, any files specified with '-i', and any
+URLs specified with '-u'.  Inputs compressed with gzip, bz2 or xz are
+decompressed as they are read.
+
+If the -w option is given then hosts is written to instead.
+
+
+Examples:
+
+  To update your hosts file from the file 'new-addresses.txt'
+    %prog -w -i new-addresses.txt
+
+  To update hosts from a URL
+    %prog -w -u https://github.com/ghettonet/GhettoNet
+  Since updating a hosts file requires system privileges, a typical use on
+  Linux might look like:
+    sudo %prog -w -u https://github.com/ghettonet/GhettoNet
+
+  To display ghettonet entries in your hosts file
+    %prog
+
+  To remove all ghettonet entries from your hosts file
+    %prog -w -x
+
+  To add an address:
+    %prog -w -4 1.2.3.4 -n example.com
+
+  To remove an address:
+    %prog -w -r 1.2.3.4
+
+  To remove a range of addresses:
+    %prog -w -r 1.2.3.0/24
+''', version=__VERSION__)
+
+    parser.add_option('-q', '--quiet', action='store_true', default=False,
+                      dest='quiet', help='suppress messages')
+    parser.add_option('-t', '--test', action='store_true', default=False,
+                      dest='doctests', help='run doctests')
+    parser.add_option('--stats', action='store_true', default=False,
+                      dest='stats', help='print the time taken and counts '
+                      'for each stage and source')
+    parser.add_option('--stats-json', action='store', type='string',
+                      dest='stats_json', metavar='FILE', default=None,
+                      help='write the times and counts to FILE as JSON')
+    parser.add_option('--merge-memory', action='store', type='float',
+                      dest='merge_memory', metavar='MB', default=None,
+                      help='merge through temporary files, using about MB '
+                      'megabytes of memory, for inputs too large to merge '
+                      'in memory (entries are then written in IPv4 order, '
+                      'each with the date and comments of its first name)')
+
+    group = OptionGroup(parser, 'Sources')
+    group.add_option('-i', '--input', action='append', type='string',
+                     dest='inputs', metavar='FILE', default=[],
+                     help='read input from FILE (repeatable)')
+    group.add_option('-s', '--stdin', action='store_true', default=False,
+                     dest='stdin', help='read input from a pipe')
+    group.add_option('-u', '--url', action='append', type='string',
+                     dest='urls', metavar='URL', default=[],
+                     help='read input from URL (repeatable)')
+    group.add_option('--workers', action='store', type='int',
+                     dest='workers', metavar='N', default=4,
+                     help='number of URLs to fetch at once (default 4)')
+    group.add_option('--timeout', action='store', type='float',
+                     dest='timeout', metavar='SECONDS', default=None,
+                     help='time allowed to fetch each URL')
+    group.add_option('--cache', action='store', type='string',
+                     dest='cache', metavar='DIR', default=None,
+                     help='keep URL contents in DIR to avoid reloading')
+    group.add_option('--cache-size', action='store', type='float',
+                     dest='cache_size', metavar='MB', default=100,
+                     help='maximum size of the cache (default 100)')
+    group.add_option('--processes', action='store', type='int',
+                     dest='processes', metavar='N', default=1,
+                     help='number of processes used to parse files '
+                     '(default 1)')
+    group.add_option('--sources', action='store', type='int',
+                     dest='sources', metavar='N', default=1,
+                     help='number of sources (hosts file, files, URLs and '
+                     'pipe) read at once (default 1, and 1 with --stats)')
+    group.add_option('--parse-cache', action='store', type='float',
+                     dest='parse_cache', metavar='MB', default=64,
+                     help='size of the data whose parsed entries are kept '
+                     'so that repeated sources and blocks are parsed once '
+                     '(default 64)')
+    group.add_option('--snapshot', action='store', type='string',
+                     dest='snapshot', metavar='FILE', default=None,
+                     help='keep parsed files in FILE to avoid parsing again '
+                     '(default PATH.ghettonet/SNAPSHOT when writing with -w)')
+    group.add_option('--no-snapshot', action='store_true', default=False,
+                     dest='no_snapshot', help='always parse files')
+    parser.add_option_group(group)
+
+    group = OptionGroup(parser, 'Hosts file')
+    group.add_option('-p', '--path', action='store', type='string',
+                     dest='path', metavar='PATH', default=None,
+                     help='path to hosts file')
+    group.add_option('-w', '--write', action='store_true', default=False,
+                     dest='write', help='write to the hosts file')
+    group.add_option('-x', '--exclude', action='store_true', default=False,
+                     dest='exclude', help='exclude the hosts file from input')
+    parser.add_option_group(group)
+
+    group = OptionGroup(parser, 'Layout')
+    group.add_option('--order', action='store', type='choice',
+                     choices=list(Layout.ORDERS), dest='order', 
+                     metavar='ORDER', default=None,
+                     help='order entries by %s (with --hits, '
+                     'the default is hits)' % ', '.join(Layout.ORDERS))
+    group.add_option('--hits', action='store', type='string',
+                     dest='hits', metavar='FILE', default=None,
+                     help='read the number of times each name is used '
+                     '(lines of "COUNT NAME") from FILE')
+    group.add_option('--names-per-line', action='store', type='int',
+                     dest='per_line', metavar='N', default=None,
+                     help='write at most N names on each line')
+    group.add_option('--output-compression', action='store', type='choice',
+                     choices=list(COMPRESSIONS), dest='output_compression',
+                     metavar='FORMAT', default=None,
+                     help='compress the entries written to stdout with '
+                     'FORMAT (%s)' % ', '.join(COMPRESSIONS))
+    parser.add_option_group(group)
+
+    group = OptionGroup(parser, 'Backups')
+    group.add_option('--backup-dir', action='store', type='string',
+                     dest='backup_dir', metavar='DIR', default=None,
+                     help='keep backups of the hosts file in DIR '
+                     '(default PATH.ghettonet)')
+    group.add_option('--keep', action='store', type='int',
+                     dest='keep', metavar='N', default=10,
+                     help='number of backups to keep (default 10)')
+    group.add_option('--keep-days', action='store', type='float',
+                     dest='keep_days', metavar='DAYS', default=None,
+                     help='discard backups older than DAYS')
+    group.add_option('--compress', action='store_true', default=False,
+                     dest='compress', help='compress older backups')
+    group.add_option('--list-backups', action='store_true', default=False,
+                     dest='list_backups', help='list the backups and exit')
+    group.add_option('--restore', action='store', type='int',
+                     dest='restore', metavar='N', default=None,
+                     help='restore backup N (0 is the most recent) and exit')
+    parser.add_option_group(group)
+
+    group = OptionGroup(parser, 'Watch')
+    group.add_option('--watch', action='store_true', default=False,
+                     dest='watch', help='keep running, updating the hosts '
+                     'file (-w) when the inputs change')
+    group.add_option('--refresh', action='store', type='float',
+                     dest='refresh', metavar='SECONDS', default=600,
+                     help='time between reading URLs again (default 600)')
+    group.add_option('--poll', action='store', type='float',
+                     dest='poll', metavar='SECONDS', default=1,
+                     help='time between checking files, if they cannot be '
+                     'watched (default 1)')
+    parser.add_option_group(group)
+
+    group = OptionGroup(parser, 'DNS')
+    group.add_option('--dns', action='store', type='int',
+                     dest='dns', metavar='PORT', default=None,
+                     help='answer DNS queries for the entries on PORT')
+    group.add_option('--dns-address', action='store', type='string',
+                     dest='dns_address', metavar='ADDRESS', 
+                     default='127.0.0.1',
+                     help='address for DNS queries (default 127.0.0.1)')
+    group.add_option('--upstream', action='store', type='string',
+                     dest='upstream', metavar='HOST[:PORT]', default=None,
+                     help='DNS server for other names (otherwise they do '
+                     'not exist)')
+    group.add_option('--ttl', action='store', type='int',
+                     dest='ttl', metavar='SECONDS', default=300,
+                     help='time for which DNS answers can be cached '
+                     '(default 300)')
+    parser.add_option_group(group)
+
+    group = OptionGroup(parser, 'Add an entry')
+    group.add_option('-4', '--ipv4', action='store', type='string',
+                     dest='ipv4', metavar='IPV4', default='',
+                     help='IPv4 address to add')
+    group.add_option('-n', '--name', action='append', type='string',
+                     dest='names', metavar='NAME', default=[],
+                     help='name to add (repeatable)')
+    group.add_option('-c', '--comment', action='append', type='string',
+                     dest='comments', metavar='COMMENT', default=[],
+                     help='comment to add (repeatable)')
+    group.add_option('-d', '--date', action='store', type='string',
+                     dest='date', metavar='DATE', default='',
+                     help='date to add')
+    parser.add_option_group(group)
+
+    group = OptionGroup(parser, 'Remove entries')
+    group.add_option('-r', '--remove', action='append', type='string',
+                     dest='remove', metavar='IPV4', default=[],
+                     help='IPv4 address or CIDR block (1.2.3.0/24) to '
+                     'remove (repeatable)')
+    group.add_option('--remove-file', action='append', type='string',
+                     dest='remove_files', metavar='FILE', default=[],
+                     help='file of IPv4 addresses or CIDR blocks to remove, '
+                     'one per line (repeatable)')
+    group.add_option('--remove-name', action='append', type='string',
+                     dest='remove_names', metavar='NAME', default=[],
+                     help='name to remove, or *.DOMAIN for all names under '
+                     'DOMAIN (repeatable)')
+    parser.add_option_group(group)
+
+    group = OptionGroup(parser, 'Deltas')
+    group.add_option('--delta', action='store', type='string',
+                     dest='delta', metavar='FILE', default=None,
+                     help='print only the changes from the entries in FILE '
+                     '(names that were dropped are given with ## REMOVE)')
+    group.add_option('--since', action='store', type='string',
+                     dest='since', metavar='DATE', default=None,
+                     help='skip entries dated before DATE in files, URLs '
+                     'and stdin')
+    parser.add_option_group(group)
+
+    group = OptionGroup(parser, 'Find entries')
+    group.add_option('--find', action='append', type='string',
+                     dest='find', metavar='NAME', default=[],
+                     help='print the address for NAME, or for all names '
+                     'under DOMAIN with *.DOMAIN, instead of writing '
+                     '(repeatable)')
+    parser.add_option_group(group)
+
+    return parser
+
+
+def layout_options(options):
+    '''
+    The Layout given by the command line options, or None.
+    '''
+    if options.order or options.hits or options.per_line:
+        hits = None
+        if options.hits:
+            hits = read_hits(options.hits)
+        return Layout(order=options.order or (options.hits and 'hits') or 'ipv4',
+                      hits=hits, per_line=options.per_line)
+
+
+def remove_options(options):
+    '''
+    The AddressRanges to remove, given by the command line options.
+    '''
+    addresses = list(options.remove)
+    for path in options.remove_files:
+        addresses.extend(read_addresses(path))
+    return AddressRanges(addresses)
+
+
+def plan_options(options):
+    '''
+    The FilterPlan given by the command line options (the names removed by
+    entries are added as they are read, see split_removals()).
+    '''
+    return FilterPlan(ranges=remove_options(options), 
+                      patterns=options.remove_names)
+
+
+def source_options(options):
+    '''
+    The options for reading and merging the sources, as keyword arguments
+    for Watcher, so that a watched run reads and merges as a single run
+    does.  The default snapshot is only used when writing the hosts file.
+    '''
+    since = None
+    if options.since:
+        since = Entry().set_date('## DATE %s' % options.since).date
+    snapshot = None
+    if not options.no_snapshot:
+        path = options.path or DEFAULT_HOSTS.get(system())
+        if options.snapshot:
+            snapshot = Snapshot(options.snapshot)
+        elif options.write and path:
+            snapshot = Snapshot(join(backup_directory(path), 'SNAPSHOT'))
+    cache = None
+    if options.cache:
+        from ghettonet.network import UrlCache
+        cache = UrlCache(options.cache, 
+                         max_size=int(options.cache_size * 1024 * 1024))
+    budget = None
+    if options.merge_memory is not None:
+        budget = int(options.merge_memory * 1024 * 1024)
+    return {'quiet': options.quiet, 'since': since, 'snapshot': snapshot,
+            'processes': options.processes, 'timeout': options.timeout, 
+            'cache': cache, 'budget': budget}
+
+
+def from_options(options):
+    '''
+    Generate an entry from the command line options.
+    '''
+    if options.ipv4 or options.names or options.comments or options.date:
+        if not options.ipv4:
+            raise Exception('Missing IPv4 address (-4)')
+        if not options.names:
+            raise Exception('Missing names (-n)')
+        entry = Entry(comments = map(lambda c: '# %s' % strip_comment(c), 
+                                     options.comments))
+        entry.set_address('%s %s' % (options.ipv4, ' '.join(options.names)))
+        if options.date:
+            entry.set_date('## DATE %s' % options.date)
+        yield entry
+
+
+# the modules tested by -t (in order of dependency)
+MODULES = ['ghettonet', 'ghettonet.core', 'ghettonet.merging', 
+           'ghettonet.stats', 'ghettonet.hosts', 'ghettonet.sources',
+           'ghettonet.network', 'ghettonet.watch', 'ghettonet.dns',
+           'ghettonet.cli']
+
+
+def main(argv=None):
+    '''
+    This is the main driver for the command line utility.  It also shows
+    how the routines in the other modules can be used together - the 
+    various "from_" routines provide a source of Entry instances which are
+    then merged and filtered before writing.
+
+    The network, DNS and watching modules (and doctest) are only imported
+    when they are needed, so that common invocations start quickly.
+    '''
+    parser = build_parser()
+    (options, args) = parser.parse_args(argv)
+    PARSED.max_size = int(options.parse_cache * 1024 * 1024)
+    if options.doctests:
+        from doctest import testmod
+        for name in MODULES:
+            testmod(__import__(name, fromlist=['']), verbose=True)
+    elif args:
+        parser.error('Missing option flag (do you need to include -i?)')
+    elif options.watch and not options.write:
+        parser.error('--watch requires -w')
+    elif options.watch and options.stdin:
+        parser.error('--watch cannot be used with -s')
+    elif options.watch and options.dns is not None:
+        parser.error('--watch cannot be used with --dns')
+    elif options.delta and (options.write or options.dns is not None):
+        parser.error('--delta cannot be used with -w or --dns')
+    elif options.output_compression and \
+            (options.write or options.dns is not None or options.find):
+        parser.error('--output-compression cannot be used with -w, --dns '
+                     'or --find')
+    elif options.list_backups or options.restore is not None:
+        path = get_hosts_path(path=options.path)
+        backups = BackupStore(options.backup_dir or backup_directory(path),
+                              keep=options.keep, max_age=options.keep_days,
+                              compress=options.compress)
+        if options.restore is not None:
+            backups.restore(options.restore, path, quiet=options.quiet)
+        else:
+            for (number, when, digest, size) in backups.list():
+                print '%3d  %s  %8d  %s' % \
+                    (number, datetime.fromtimestamp(int(when)), size, digest)
+    elif options.watch:
+        from ghettonet.watch import Watcher
+        path = get_hosts_path(path=options.path)
+        backups = BackupStore(options.backup_dir or backup_directory(path),
+                              keep=options.keep, max_age=options.keep_days,
+                              compress=options.compress)
+        plan = plan_options(options)
+        watcher = Watcher(options.inputs, options.urls, hosts_path=path,
+                          exclude=options.exclude, remove=plan.ranges,
+                          remove_names=plan.patterns,
+                          extra=list(from_options(options)), 
+                          backups=backups, refresh=options.refresh, 
+                          poll=options.poll, layout=layout_options(options),
+                          **source_options(options))
+        try:
+            watcher.run()
+        except KeyboardInterrupt:
+            pass
+    else:
+        read = source_options(options)
+        (since, snapshot, cache, budget) = \
+            (read['since'], read['snapshot'], read['cache'], read['budget'])
+        layout = layout_options(options)
+        plan = plan_options(options)
+        stats = None
+        if options.stats or options.stats_json:
+            stats = Stats()
+        sources = [from_options(options),
+                   from_hosts(path=options.path, exclude=options.exclude, 
+                              quiet=options.quiet, snapshot=snapshot,
+                              stats=stats),
+                   from_paths(options.inputs, quiet=options.quiet,
+                              snapshot=snapshot, 
+                              processes=options.processes, stats=stats,
+                              since=since)]
+        if options.urls:
+            from ghettonet.network import from_urls
+            sources.append(from_urls(options.urls, quiet=options.quiet,
+                                     workers=options.workers,
+                                     timeout=options.timeout, cache=cache,
+                                     stats=stats, since=since))
+        sources.append(from_stdin(options.stdin, quiet=options.quiet,
+                                  stats=stats, since=since))
+        if options.sources > 1 and stats is not None:
+            # Stats is not thread safe, and times taken in parallel would
+            # not add up, so sources are read one at a time
+            print >> stderr, 'WARNING: Reading one source at a time ' \
+                'for --stats (--sources %d ignored)' % options.sources
+        if options.sources > 1 and stats is None:
+            entries = ingest(sources, workers=options.sources)
+        else:
+            entries = chain(*sources)
+        entries = split_removals(entries, plan.removals)
+        entries = merge(entries, quiet=options.quiet, stats=stats, 
+                        budget=budget, plan=plan)
+        if options.delta:
+            old = merge(from_paths([options.delta], quiet=options.quiet),
+                        quiet=options.quiet)
+            entries = delta(old, entries, 
+                            date=datetime.now().replace(microsecond=0))
+        if options.dns is not None:
+            entries = list(entries)
+        if options.find:
+            index = NameIndex(entries)
+            for pattern in options.find:
+                for (name, entry) in index.find(pattern):
+                    print '%s    %s' % (entry.ipv4, name)
+        elif options.write:
+            path = get_hosts_path(path=options.path)
+            backups = BackupStore(options.backup_dir or backup_directory(path),
+                                  keep=options.keep, 
+                                  max_age=options.keep_days,
+                                  compress=options.compress)
+            update_hosts(entries, erase=options.exclude, hosts_path=path, 
+                         quiet=options.quiet, backups=backups, stats=stats,
+                         layout=layout)
+        elif options.output_compression:
+            out = CompressedOutput(stdout, options.output_compression)
+            try:
+                write(out, entries, stats=stats, layout=layout)
+            finally:
+                out.close()
+        elif options.dns is None:
+            write(stdout, entries, stats=stats, layout=layout)
+        if snapshot is not None:
+            snapshot.save(quiet=options.quiet)
+        if options.stats:
+            stats.report(stderr)
+        if options.stats_json:
+            out = open(options.stats_json, 'w')
+            try:
+                stats.report_json(out)
+            finally:
+                out.close()
+        if options.dns is not None:
+            from ghettonet.dns import DnsResponder, parse_upstream
+            upstream = None
+            if options.upstream:
+                upstream = parse_upstream(options.upstream)
+            responder = DnsResponder(entries, 
+                                     address=(options.dns_address, 
+                                              options.dns),
+                                     upstream=upstream, ttl=options.ttl,
+                                     quiet=options.quiet)
+            if not options.quiet:
+                print >> stderr, 'Answering DNS queries on %s:%d' % \
+                    responder.address
+            try:
+                responder.serve_forever()
+            except KeyboardInterrupt:
+                pass
@@ -0,0 +1,1159 @@
+'''
+The GhettoNet format: parsing, scanning and reading (possibly
+compressed) sources.
+'''
+
+
+from array import array
+from bz2 import BZ2Compressor, BZ2Decompressor
+from collections import OrderedDict
+from cStringIO import StringIO
+from datetime import datetime
+from hashlib import sha1
+from itertools import chain, izip
+from mmap import mmap, ACCESS_READ
+from os import linesep, remove, rename
+from os.path import exists
+from re import compile as compile_
+from socket import inet_aton, inet_ntoa, error as socket_error
+from sys import stderr, exc_info, byteorder, modules
+from threading import Lock
+from zlib import compressobj, decompressobj, error as ZlibError, DEFLATED, \
+    MAX_WBITS
+
+try:
+    from lzma import LZMACompressor, LZMADecompressor, LZMAError
+except ImportError: # not in Python 2 (but see backports.lzma)
+    try:
+        from backports.lzma import LZMACompressor, LZMADecompressor, \
+            LZMAError
+    except ImportError:
+        (LZMACompressor, LZMADecompressor, LZMAError) = (None, None, None)
+
+
+EOL = compile_(r'\r?\n')
+
+# these match entire lines
+BEGIN = compile_(r'(?i)^\s*#{2,}\s*BEGIN\s*GHETTONET')
+END = compile_(r'(?i)^\s*#{2,}\s*END\s*GHETTONET')
+DATE = compile_(r'(?i)^\s*#{2,}\s*DATE\s*(?P<year>\d{4})-(?P<month>\d\d?)-(?P<day>\d\d?)(\s+(?P<hour>\d\d?):(?P<min>\d\d?)(:(?P<sec>\d\d?))?)?(\s+(?P<extra>.*))?$')
+POSSIBLE_DATE = compile_(r'(?i)^\s*#{2,}\s*DATE')
+
+# these match fragments of a line
+IPV4 = compile_(r'^\s*(\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3})(.*)')
+# this attempts to drop embedded HTML to help pull from web pages
+NAME = compile_(r'^\s*([\w\-]+(?:\.[\w\-]+)*)(.*)')
+# all the names after an address, which NAME would match in turn (names 
+# must be separated by spaces, since NAME is greedy)
+NAMES = compile_(r'\s*[\w\-]+(?:\.[\w\-]+)*(?:\s+[\w\-]+(?:\.[\w\-]+)*)*$')
+# a typical address line (anything else is handled by IPV4 and NAMES)
+ADDRESS = compile_(r'((\d{1,3})\.(\d{1,3})\.(\d{1,3})\.(\d{1,3}))((?:\s+[\w\-]+(?:\.[\w\-]+)*)*)$')
+
+# the start of a (stripped) line that matches BEGIN, END or POSSIBLE_DATE,
+# with the group giving the kind (see classify())
+MARKER = compile_(r'(?i)#{2,}\s*(?:(B)EGIN\s*GHETTONET|(E)ND\s*GHETTONET|(D)ATE)')
+MARKERS = (None, 'begin', 'end', 'date')
+
+# clunky removal of HTML markup
+HTML = compile_(r'<[^<>]+>')
+
+# this finds lines that might match BEGIN once HTML is removed, so that the
+# scanner can skip directly to them
+MAYBE_BEGIN = compile_(r'(?i)' + r'(?:<[^<>\n]+>)*'.join('ghettonet'))
+
+# size of the pieces read from streams that cannot be memory mapped
+CHUNK = 1 << 16
+
+# the compressed formats that are read and written, and the (offset, bytes)
+# at the start of data in each (see compression()); for bz2 the block size
+# digit is skipped
+COMPRESSIONS = ('gzip', 'bz2', 'xz')
+MAGIC = {'gzip': ((0, '\x1f\x8b\x08'),),
+         'bz2': ((0, 'BZh'), (4, '1AY&SY')),
+         'xz': ((0, '\xfd7zXZ\x00'),)}
+
+# values shared between entries (see share())
+SHARED = {}
+
+# recently parsed date lines (see Entry.set_date())
+DATES = {}
+
+# the comment, and the address, of an entry that removes names (see delta())
+REMOVE = '## REMOVE'
+REMOVE_IPV4 = '0.0.0.0'
+
+# the values of the parts of an IPv4 address (including forms with leading
+# zeroes, which are normalised)
+OCTETS = dict((format % value, value) for value in range(256) 
+              for format in ('%d', '%02d', '%03d'))
+
+# the type code for arrays of packed IPv4 addresses
+IPV4_ARRAY = array('I').itemsize == 4 and 'I' or 'L'
+
+
+class ParseException(Exception):
+    pass
+
+
+def remove_html(line):
+    return ''.join(HTML.split(line))
+
+
+def clean(line):
+    '''
+    Remove HTML and surrounding spaces from a line.
+    '''
+    if '<' in line:
+        line = ''.join(HTML.split(line))
+    return line.strip()
+
+
+def classify(line):
+    '''
+    Classify a cleaned line (see clean()) as 'begin', 'end' or 'date' (if
+    it matches BEGIN, END or POSSIBLE_DATE), 'comment' (comments and blank
+    lines) or 'address' (anything else).  This replaces trying each 
+    regular expression in turn, and most lines need no regular expression.
+
+    >>> [classify(clean(line)) for line in ['<p>### Begin GhettoNet</p>',
+    ...     '##endghettonet', ' ## DATE 2010-12-04', '# ## DATE', '', 
+    ...     '1.2.3.4 a.b', 'junk']]
+    ['begin', 'end', 'date', 'comment', 'comment', 'address', 'address']
+    '''
+    if not line:
+        return 'comment'
+    if line[0] == '#':
+        if line[1:2] == '#':
+            match = MARKER.match(line)
+            if match:
+                return MARKERS[match.lastindex]
+        return 'comment'
+    return 'address'
+
+
+def share(value):
+    '''
+    Return a single, shared instance of equal values, to save memory when
+    the same names, comments and dates appear in many entries.  Strings
+    are interned; other values are held in SHARED.
+    '''
+    if value.__class__ is str:
+        return intern(value)
+    return SHARED.setdefault(value, value)
+
+
+def pack_ipv4(address):
+    '''
+    The 32 bit integer for a dotted IPv4 address, or None if the address is
+    not valid.  Leading zeroes are accepted (and so normalised).
+
+    >>> pack_ipv4('1.2.3.4'), pack_ipv4('01.2.3.004')
+    (16909060, 16909060)
+    >>> print pack_ipv4('256.2.3.4'), pack_ipv4('1x2x3x4')
+    None None
+    '''
+    parts = address.split('.')
+    if len(parts) != 4:
+        return None
+    try:
+        (a, b, c, d) = [OCTETS[part] for part in parts]
+    except KeyError:
+        return None
+    return a << 24 | b << 16 | c << 8 | d
+
+
+def pack_ipv4s(addresses):
+    '''
+    Pack a sequence of dotted IPv4 addresses in a single pass, returning an
+    array of 32 bit integers and a list of (index, address) for any that
+    are not valid (which are packed as zero).  Addresses in the usual form
+    are converted and checked in bulk (the loops are within map(), and the
+    check is that inet_ntoa() gives the original address), which is about
+    twice as fast as calling pack_ipv4() for each, and several times faster
+    than matching IPV4.  Otherwise each is packed separately.
+
+    >>> (packed, bad) = pack_ipv4s(['1.2.3.4', '10.0.0.010', '1.2.3', 
+    ...                             '1.2.3.999', '1.2.3.4.5'])
+    >>> map(unpack_ipv4, packed)
+    ['1.2.3.4', '10.0.0.10', '0.0.0.0', '0.0.0.0', '0.0.0.0']
+    >>> bad
+    [(2, '1.2.3'), (3, '1.2.3.999'), (4, '1.2.3.4.5')]
+    '''
+    if not isinstance(addresses, list):
+        addresses = list(addresses)
+    if IPV4_ARRAY == 'I':
+        try:
+            packed = map(inet_aton, addresses)
+        except (socket_error, TypeError):
+            packed = None
+        if packed is not None and map(inet_ntoa, packed) == addresses:
+            packed = array(IPV4_ARRAY, ''.join(packed))
+            if byteorder == 'little':
+                packed.byteswap()
+            return (packed, [])
+    # at least one is not valid or not in the usual form, so pack them
+    # separately to find which
+    (packed, bad) = (array(IPV4_ARRAY), [])
+    for (index, address) in enumerate(addresses):
+        value = pack_ipv4(address)
+        if value is None:
+            bad.append((index, address))
+            value = 0
+        packed.append(value)
+    return (packed, bad)
+
+
+def unpack_ipv4(packed):
+    '''
+    The dotted form of a 32 bit IPv4 address.
+
+    >>> unpack_ipv4(16909060)
+    '1.2.3.4'
+    '''
+    return '%d.%d.%d.%d' % (packed >> 24, packed >> 16 & 255, 
+                            packed >> 8 & 255, packed & 255)
+
+
+class Entry(object):
+    '''
+    An entry, combining an IPv4 address, some names, a possible date,
+    and additional comments.
+
+    To reduce memory use with large numbers of entries there is no instance
+    dictionary, the address is stored as an integer (when valid), and names,
+    comments and dates are shared between entries.  The names and comments
+    of parsed entries are held as tuples, which clones share; they become
+    lists only when accessed through the attributes, so that changes affect
+    a single entry.
+    '''
+
+    __slots__ = ('_ipv4', '_names', 'date', 'date_extra', '_comments')
+    
+    def __init__(self, ipv4=None, names=None, date=None, date_extra=None, 
+                 comments=None):
+        if names is None: names = []
+        if comments is None: comments = []
+        self.ipv4 = ipv4
+        self.names = names
+        self.date = date
+        self.date_extra = date_extra
+        self.comments = comments
+
+    def get_ipv4(self):
+        ipv4 = self._ipv4
+        if ipv4.__class__ is int or ipv4.__class__ is long:
+            return unpack_ipv4(ipv4)
+        return ipv4
+
+    def set_ipv4(self, ipv4):
+        if ipv4.__class__ is str:
+            packed = pack_ipv4(ipv4)
+            if packed is not None:
+                ipv4 = packed
+        self._ipv4 = ipv4
+
+    ipv4 = property(get_ipv4, set_ipv4)
+
+    def get_names(self):
+        if self._names.__class__ is tuple:
+            self._names = list(self._names)
+        return self._names
+
+    def set_names(self, names):
+        self._names = names
+
+    names = property(get_names, set_names)
+
+    def get_comments(self):
+        if self._comments.__class__ is tuple:
+            self._comments = list(self._comments)
+        return self._comments
+
+    def set_comments(self, comments):
+        self._comments = comments
+
+    comments = property(get_comments, set_comments)
+
+    @classmethod
+    def from_lines(cls, lines, kinds=None):
+        '''
+        Create a single object from the text that defines it (a set of 
+        lines, as extracted by parse()).  The kinds of the lines (see 
+        classify()) can be given if already known.
+        '''
+        if kinds is None:
+            kinds = map(classify, lines)
+        entry = cls.__new__(cls)
+        (entry._ipv4, entry.date, entry.date_extra) = (None, None, None)
+        (entry._names, entry._comments) = ([], [])
+        comments = []
+        for (line, kind) in izip(lines, kinds):
+            if kind == 'address':
+                entry.set_address(line)
+            elif kind == 'date' and not entry.date:
+                entry.set_date(line)
+            else:
+                comments.append(intern(line))
+        entry._names = tuple(entry._names)
+        entry._comments = tuple(comments)
+        if entry._ipv4 is None:
+            raise ParseException('No IPv4 address in%s%s' %
+                                 (linesep, linesep.join(lines)))
+        if not entry._names:
+            raise ParseException('No names in%s%s' %
+                                 (linesep, linesep.join(lines)))
+        return entry
+
+    def set_date(self, line):
+        '''
+        Parse date from the given line.  See DATE for the regular expression
+        accepted.  We parse by hand because Python 2.4 didn't have strptime.
+
+        >>> Entry().set_date('## DATE 2010-12-04').format_date()
+        ['## DATE 2010-12-04 00:00:00']
+        >>> Entry().set_date('## DATE 2010-12-04 17:44').format_date()
+        ['## DATE 2010-12-04 17:44:00']
+        >>> Entry().set_date('## DATE 2010-12-04 00:00:00 extra').format_date()
+        ['## DATE 2010-12-04 00:00:00 extra']
+        '''
+        if self.date:
+            raise ParseException('Duplicate date: %s' % line)
+        if line in DATES:
+            (self.date, self.date_extra) = DATES[line]
+            return self
+        match = DATE.match(line)
+        if not match:
+            raise ParseException('Bad date: %s' % line)
+        try:
+            (year, month, day, hour, minute, second, extra) = match.group(
+                'year', 'month', 'day', 'hour', 'min', 'sec', 'extra')
+            self.date = share(datetime(int(year), int(month), int(day),
+                                       int(hour or 0), int(minute or 0),
+                                       int(second or 0)))
+            self.date_extra = share(extra or '')
+        except:
+            raise ParseException('Could not parse date: %s (%s)' % 
+                                 (line, exc_info()[1]))
+        if len(DATES) >= 10000:
+            DATES.clear()
+        DATES[line] = (self.date, self.date_extra)
+        return self # allow chaining
+    
+    def format_date(self):
+        '''
+        Returns a list containing at most one line, with the formatted date
+        '''
+        if self.date:
+            line = '## DATE ' + self.date.isoformat(' ')
+            if self.date_extra:
+                line = line + ' ' + self.date_extra
+            return [line]
+        else:
+            return []
+
+    def set_address(self, line):
+        '''
+        Parse the IPv4 address and associated names from the given line.
+        Leading zeroes in the address are dropped.
+        
+        >>> Entry().set_address('1.2.3.4 a.b.c p.q').format_address()
+        ['1.2.3.4    a.b.c p.q']
+        >>> Entry().set_address('010.2.3.4 a.b.c').format_address()
+        ['10.2.3.4    a.b.c']
+        >>> Entry().set_address('999.2.3.4 a.b.c')
+        Traceback (most recent call last):
+          ...
+        ParseException: Bad IPv4 address: 999.2.3.4 a.b.c
+        '''
+        match = ADDRESS.match(line)
+        if match:
+            (ipv4, a, b, c, d, rest) = match.groups()
+            try:
+                self._ipv4 = OCTETS[a] << 24 | OCTETS[b] << 16 | \
+                    OCTETS[c] << 8 | OCTETS[d]
+            except KeyError:
+                raise ParseException('Bad IPv4 address: %s' % line)
+        else:
+            match = IPV4.match(line)
+            if not match or (match.group(2) and 
+                             not NAMES.match(match.group(2))):
+                raise ParseException('Could not parse addresses: %s' % line)
+            (ipv4, rest) = match.groups()
+            self._ipv4 = pack_ipv4(ipv4)
+            if self._ipv4 is None:
+                raise ParseException('Bad IPv4 address: %s' % line)
+        self.names.extend(map(intern, rest.lower().split()))
+        return self # allow chaining
+
+    def format_address(self):
+        '''
+        Returns a list containing a single line, with the formatted date
+        '''
+        names = list(self._names)
+        names.sort(key=lambda n: len(n), reverse=True)
+        return ['%s    %s' % (self.ipv4, ' '.join(names))]
+
+    def format_comments(self):
+        '''
+        Strip leading blank lines, since they are added on writing.
+        '''
+        comments = list(self._comments)
+        while comments and not comments[0].strip():
+            comments = comments[1:]
+        return comments
+
+    def __str__(self):
+        '''
+        In the GhettoNet format.
+        '''
+        return linesep.join(self.format_comments() + self.format_date() + 
+                            self.format_address())
+
+    def __repr__(self):
+        '''
+        Compact display fro debuging.
+        '''
+        return '<Entry %s:%s %s %s>' % (self.ipv4, ';'.join(self._names),
+                                        self.format_date(), 
+                                        list(self._comments))
+
+    def as_tuple(self):
+        '''
+        A compact form of the entry, for storage (see from_tuple()).
+        '''
+        return (self._ipv4, tuple(self._names), self.date, self.date_extra,
+                tuple(self._comments))
+
+    @classmethod
+    def from_tuple(cls, data, shared=False):
+        '''
+        Recreate an entry from the value returned by as_tuple().  If shared
+        is True then the values are known to be shared already (the value 
+        was not pickled, for example).
+
+        >>> Entry.from_tuple(Entry(ipv4='1.2.3.4', names=['a'], 
+        ...                        comments=['# b']).as_tuple())
+        <Entry 1.2.3.4:a [] ['# b']>
+        '''
+        (ipv4, names, date, date_extra, comments) = data
+        entry = cls.__new__(cls)
+        entry._ipv4 = ipv4
+        if shared:
+            (entry._names, entry.date, entry.date_extra, entry._comments) = \
+                (names, date, date_extra, comments)
+            return entry
+        entry._names = tuple(map(share, names))
+        entry.date = date and share(date)
+        entry.date_extra = date_extra and share(date_extra)
+        entry._comments = tuple(map(share, comments))
+        return entry
+
+    def clone(self, names=None):
+        '''
+        A copy of this entry (optionally with different names).  Names and
+        comments are copied only if they are lists; tuples are shared.
+        '''
+        clone = Entry.__new__(Entry)
+        clone._ipv4 = self._ipv4
+        if names is None:
+            names = tuple(self._names)
+        clone._names = names
+        clone.date = self.date
+        clone.date_extra = self.date_extra
+        clone._comments = tuple(self._comments)
+        return clone
+
+    def single_name(self, name):
+        '''
+        Return a clone of this entry, but with a single name (we can re-use 
+        this instance if this entry only has one name).
+        '''
+        assert name in self._names
+        if len(self._names) == 1:
+            return self
+        else:
+            return self.clone(names=(name,))
+
+
+def parse(contents, quiet=True, fragile=False):
+    '''
+    Parse lines of input, generating a sequence of (True, entry) or 
+    (False, lines) pairs.
+
+    >>> list(parse(['a', 'b']))
+    [(False, ['a', 'b'])]
+    >>> list(parse(['### BEGIN GHETTONET',
+    ...             '# comment',
+    ...             '',
+    ...             '## DATE 2010-12-04',
+    ...             '127.0.0.1 localhost',
+    ...             '### END GHETTONET']))
+    [(True, <Entry 127.0.0.1:localhost ['## DATE 2010-12-04 00:00:00'] ['# comment', '']>)]
+    >>> list(parse(['### BEGIN GHETTONET',
+    ...             '# comment',
+    ...             '',
+    ...             '## DATE 2010-12-04',
+    ...             '<span>127.0.0.1 <a href="">localhost</a></span>',
+    ...             '### END GHETTONET']))
+    [(True, <Entry 127.0.0.1:localhost ['## DATE 2010-12-04 00:00:00'] ['# comment', '']>)]
+    '''
+
+    in_text, lines, kinds = True, [], []
+
+    def discard():
+        if ''.join(lines):
+            if fragile:
+                raise ParseException('Unexpected text:%s%s' %
+                                     (linesep, linesep.join(lines)))
+            elif not quiet:
+                print >> stderr, 'Ignoring text:%s%s' % \
+                                     (linesep, linesep.join(lines))
+
+    for line in contents:
+        line = clean(line)
+        kind = classify(line)
+        lines.append(line)
+        if in_text:
+            if kind == 'begin':
+                lines.pop() # drop begin
+                if lines:
+                    yield (False, lines)
+                in_text, lines, kinds = False, [], []
+        else:
+            kinds.append(kind)
+            if kind == 'end':
+                lines.pop() # drop end
+                discard()
+                in_text, lines = True, []
+            elif kind == 'address':
+                try:
+                    yield (True, Entry.from_lines(lines, kinds))
+                except ParseException:
+                    discard()
+                    in_text = True
+                lines, kinds = [], []
+    if in_text:
+        if lines:
+            yield (False, lines)
+    else:
+        discard()
+        if fragile:
+            raise ParseException('Missing END GHETTONET')
+        if not quiet:
+            print >> stderr, 'Missing END GHETTONET'
+
+
+class ParseCache(object):
+    '''
+    The results of parsing recently seen data (whole sources, and single
+    blocks), keyed by SHA-1, so that the same content arriving more than 
+    once (under another name, from a mirror, or as part of another file) 
+    is parsed only once.  Records hold entries in the form given by 
+    Entry.as_tuple().  The least recently used are dropped when the data 
+    they cover exceeds max_size bytes (so zero disables the cache).
+
+    >>> cache = ParseCache(max_size=10)
+    >>> cache.put('a', 'A', 6)
+    >>> cache.put('b', 'B', 4)
+    >>> cache.get('a')
+    'A'
+    >>> cache.put('c', 'C', 3)
+    >>> print cache.get('a'), cache.get('b'), cache.get('c')
+    A None C
+    '''
+
+    def __init__(self, max_size=64 << 20):
+        self.max_size = max_size
+        (self.records, self.size, self.lock) = (OrderedDict(), 0, Lock())
+
+    def get(self, key):
+        self.lock.acquire()
+        try:
+            record = self.records.pop(key, None)
+            if record is None:
+                return None
+            self.records[key] = record # most recently used
+            return record[1]
+        finally:
+            self.lock.release()
+
+    def put(self, key, value, size):
+        if size > self.max_size:
+            return
+        self.lock.acquire()
+        try:
+            old = self.records.pop(key, None)
+            if old is not None:
+                self.size = self.size - old[0]
+            self.records[key] = (size, value)
+            self.size = self.size + size
+            while self.size > self.max_size:
+                (old, (size, value)) = self.records.popitem(last=False)
+                self.size = self.size - size
+        finally:
+            self.lock.release()
+
+
+# the parse results shared by all scanners (see --parse-cache)
+PARSED = ParseCache()
+
+
+class Scanner(object):
+    '''
+    A streaming alternative to parse() for when only the entries are needed.
+
+    Text outside blocks is not split into lines; instead the scanner searches
+    for lines that might be begin lines and only tokenizes lines within a
+    block.  State is kept between calls to scan(), so data can be supplied
+    in pieces, each of which must end with a newline (except the last).
+
+    The (start, end) offsets of the text outside blocks (the text that 
+    parse() returns as (False, lines)) are added to text, which is only
+    useful when all the data are given in a single call.  Any warnings are
+    added to messages (and printed, unless quiet).  The number of blocks
+    found, and of blocks (or parts of blocks) discarded, are counted.
+
+    If cache (a ParseCache) is given then blocks that end normally, and
+    the data given to scan_data() with a digest, are parsed only once.
+    If since (a datetime) is given then entries dated before then are 
+    skipped (and counted) without building them.  The address line is 
+    still checked, so that a bad entry ends the block, as it does when
+    everything is parsed and old entries are dropped after (see 
+    skip_older()).
+
+    >>> scanner = Scanner()
+    >>> list(scanner.scan('junk\\n### BEGIN GHETTONET\\n# comment\\n'))
+    []
+    >>> list(scanner.scan('127.0.0.1 localhost\\n### END GHETTONET',
+    ...                   final=True))
+    [<Entry 127.0.0.1:localhost [] ['# comment']>]
+    >>> scanner.close()
+    >>> scanner.text
+    [(0, 5)]
+    >>> from datetime import datetime
+    >>> data = ('### BEGIN GHETTONET\\n## DATE 2000-01-01\\n%s\\n'
+    ...         '## DATE 2011-01-01\\n2.2.2.2 new.com\\n### END GHETTONET\\n')
+    >>> list(Scanner(since=datetime(2010, 1, 1)).scan(
+    ...     data % '1.1.1.1 old.com', final=True))
+    [<Entry 2.2.2.2:new.com ['## DATE 2011-01-01 00:00:00'] []>]
+    >>> list(Scanner(since=datetime(2010, 1, 1)).scan(
+    ...     data % '1.1.1.1 old.com bad!name', final=True))
+    []
+    '''
+
+    def __init__(self, quiet=True, fragile=False, cache=None, since=None):
+        self.quiet = quiet
+        self.fragile = fragile
+        self.since = since
+        self.in_text, self.lines, self.kinds = True, [], []
+        self.text, self.text_start = [], 0
+        self.messages = []
+        self.blocks, self.discarded, self.skipped = 0, 0, 0
+        if cache is not None and not cache.max_size:
+            cache = None
+        # the block being recorded for the cache, as (key, entries, size)
+        (self.cache, self.block) = (cache, None)
+        # the lines and bytes given to scan_chunks(), for counts()
+        self.read = None
+
+    def warn(self, message):
+        self.messages.append(message)
+        if not self.quiet:
+            print >> stderr, message
+
+    def discard(self):
+        '''
+        Drop the lines seen so far in a block (as parse() does).
+        '''
+        if ''.join(self.lines):
+            self.discarded = self.discarded + 1
+            if self.fragile:
+                raise ParseException('Unexpected text:%s%s' %
+                                     (linesep, linesep.join(self.lines)))
+            else:
+                self.warn('Ignoring text:%s%s' % 
+                          (linesep, linesep.join(self.lines)))
+
+    def scan(self, data, final=False, end=None):
+        '''
+        Generate the entries in data (a string or mmap), up to end if given.
+        If final is True then any text after the last newline is treated as
+        a line.
+        '''
+        if end is None:
+            end = len(data)
+        pos = 0
+        while True:
+            if self.in_text:
+                match = MAYBE_BEGIN.search(data, pos, end)
+                if not match:
+                    if final and self.text_start < end:
+                        self.text.append((self.text_start, end))
+                    return
+                start = max(pos, data.rfind('\n', pos, match.start()) + 1)
+                stop = data.find('\n', match.end(), end)
+                if stop < 0:
+                    stop = end
+                line, pos = data[start:stop], stop + 1
+                if classify(clean(line)) == 'begin':
+                    self.in_text, self.lines, self.kinds = False, [], []
+                    self.blocks = self.blocks + 1
+                    if self.text_start < start:
+                        self.text.append((self.text_start, start))
+                    if self.cache is not None:
+                        stop = self.block_end(data, pos, end, final)
+                        if stop is not None and \
+                                stop - pos <= self.cache.max_size:
+                            key = ('block', sha1(data[pos:stop]).digest(),
+                                   self.since)
+                            entries = self.cache.get(key)
+                            if entries is None:
+                                self.block = (key, [], stop - pos, stop)
+                            else:
+                                for entry in entries:
+                                    yield Entry.from_tuple(entry, True)
+                                pos = self.text_start = stop + 1
+                                self.in_text = True
+            else:
+                # the lines of a block are handled in this inner loop, with
+                # local names, as this is where most of the time is spent
+                (lines, kinds, find) = (self.lines, self.kinds, data.find)
+                since = self.since
+                while True:
+                    stop = find('\n', pos, end)
+                    if stop < 0:
+                        if not final or pos > end:
+                            return
+                        stop = end
+                    line, pos = data[pos:stop], stop + 1
+                    if '<' in line:
+                        line = remove_html(line)
+                    line = line.strip()
+                    if line and line[0] != '#':
+                        kind = 'address'
+                    else:
+                        kind = classify(line)
+                    lines.append(line)
+                    kinds.append(kind)
+                    if kind == 'address':
+                        if since is not None and 'date' in kinds and \
+                                self.older(lines[kinds.index('date')]) and \
+                                self.valid(line):
+                            self.skipped = self.skipped + 1
+                            (lines, kinds) = (self.lines, self.kinds) = \
+                                ([], [])
+                            continue
+                        try:
+                            entry = Entry.from_lines(lines, kinds)
+                        except ParseException:
+                            self.discard()
+                            self.in_text = True
+                            self.text_start = pos
+                            self.block = None
+                        else:
+                            if self.block is not None:
+                                self.block[1].append(entry.as_tuple())
+                            yield entry
+                        (lines, kinds) = (self.lines, self.kinds) = ([], [])
+                        if self.in_text:
+                            break
+                    elif kind == 'end':
+                        lines.pop() # drop end
+                        discarded = self.discarded
+                        self.discard()
+                        if self.block is not None and \
+                                self.discarded == discarded and \
+                                self.block[3] == stop:
+                            self.cache.put(*self.block[:3])
+                        self.in_text, self.lines = True, []
+                        (self.text_start, self.block) = (pos, None)
+                        break
+
+    def older(self, line):
+        '''
+        Is the date line before since?  Bad dates are left for from_lines()
+        to report.
+        '''
+        record = DATES.get(line)
+        if record is None:
+            try:
+                record = (Entry().set_date(line).date,)
+            except ParseException:
+                return False
+        return record[0] < self.since
+
+    def valid(self, line):
+        '''
+        Would from_lines() accept the address line?
+        '''
+        try:
+            return bool(Entry().set_address(line)._names)
+        except ParseException:
+            return False
+
+    def block_end(self, data, pos, end, final):
+        '''
+        The offset of the end of the first line after pos (up to end) that
+        looks like an END line, or None.  For speed, only END lines with
+        GHETTONET or ghettonet are found, so this may not be the line that
+        ends the block (which scan() checks before caching the block).
+        '''
+        while True:
+            found = [index for index in (data.find('GHETTONET', pos, end),
+                                         data.find('ghettonet', pos, end))
+                     if index >= 0]
+            if not found:
+                return None
+            start = data.rfind('\n', pos, min(found)) + 1
+            stop = data.find('\n', min(found), end)
+            if stop < 0:
+                if not final:
+                    return None
+                stop = end
+            line = clean(data[start:stop])
+            if line[:1] == '#' and classify(line) == 'end':
+                return stop
+            pos = stop + 1
+
+    def scan_data(self, data, digest=None):
+        '''
+        Generate the entries in data (a string or mmap), which must be 
+        complete (final).  If the digest (SHA-1) of data is given then the
+        cache (if any) is used if the same data were parsed before.
+        Compressed data are decompressed (see decoded()) and scanned in
+        pieces, caching only the blocks.
+        '''
+        if compression(data):
+            for entry in self.scan_chunks(decoded(data_chunks(data))):
+                yield entry
+            return
+        if self.cache is None or digest is None:
+            for entry in self.scan(data, final=True):
+                yield entry
+            return
+        key = ('data', digest, self.fragile, self.since)
+        record = self.cache.get(key)
+        if record is None:
+            entries = []
+            for entry in self.scan(data, final=True):
+                entries.append(entry.as_tuple())
+                yield entry
+            self.cache.put(key, (entries, list(self.messages), self.blocks, 
+                                 self.discarded, self.skipped, self.in_text, 
+                                 list(self.text), list(self.lines),
+                                 list(self.kinds)),
+                           len(data))
+        else:
+            (entries, messages, self.blocks, self.discarded, self.skipped,
+             self.in_text, text, lines, kinds) = record
+            (self.text, self.lines, self.kinds) = \
+                (list(text), list(lines), list(kinds))
+            for entry in entries:
+                yield Entry.from_tuple(entry, True)
+            for message in messages:
+                self.warn(message)
+
+    def scan_chunks(self, chunks):
+        '''
+        Generate the entries in chunks (strings, split anywhere), which are
+        all the data (final), passing complete lines to scan().
+        '''
+        (carry, lines, size) = ('', 0, 0)
+        for chunk in chunks:
+            (lines, size) = (lines + chunk.count('\n'), size + len(chunk))
+            carry = carry + chunk
+            cut = carry.rfind('\n') + 1
+            if cut:
+                for entry in self.scan(carry[:cut]):
+                    yield entry
+                carry = carry[cut:]
+        for entry in self.scan(carry, final=True):
+            yield entry
+        self.read = {'lines': lines + bool(carry), 'bytes_read': size}
+
+    def close(self):
+        '''
+        Check that the last block was closed correctly.
+        '''
+        if not self.in_text:
+            self.discard()
+            if self.fragile:
+                raise ParseException('Missing END GHETTONET')
+            self.warn('Missing END GHETTONET')
+
+    def counts(self, data=None):
+        '''
+        The counts for Stats, once all of data (a string or mmap) has been
+        scanned (the lines and bytes are those decompressed, or read by 
+        scan_chunks(), if any).
+        '''
+        counts = {'blocks': self.blocks, 'discarded': self.discarded}
+        if self.read is not None:
+            counts.update(self.read)
+        elif data is not None:
+            counts.update(lines=count_lines(data), bytes_read=len(data))
+        if self.since is not None:
+            counts['skipped'] = self.skipped
+        return counts
+
+
+def count_lines(data):
+    '''
+    The number of lines in data (a string or mmap).
+
+    >>> count_lines('a\\nb\\n'), count_lines('a\\nb'), count_lines('')
+    (2, 2, 0)
+    '''
+    lines = 0
+    for offset in xrange(0, len(data), CHUNK):
+        lines = lines + data[offset:offset+CHUNK].count('\n')
+    if len(data) and data[len(data)-1] != '\n':
+        lines = lines + 1
+    return lines
+
+
+def set_stderr(out):
+    '''
+    Replace stderr (where warnings and progress are printed) in all the 
+    GhettoNet modules, which each import it from sys, returning the old 
+    value so that it can be restored.
+
+    >>> from cStringIO import StringIO
+    >>> import ghettonet.merging
+    >>> old = set_stderr(StringIO())
+    >>> print >> ghettonet.merging.stderr, 'captured'
+    >>> set_stderr(old).getvalue()
+    'captured\\n'
+    '''
+    old = stderr
+    for (name, module) in modules.items():
+        if (name == 'ghettonet' or name.startswith('ghettonet.')) and \
+                hasattr(module, 'stderr'):
+            module.stderr = out
+    return old
+
+
+def note_access(source, quiet=True, write=False):
+    '''
+    Print a message on stderr to help the user track source access.
+    '''
+    if not quiet:
+        if write:
+            action = 'Writing to'
+        else:
+            action = 'Reading from'
+        print >> stderr, '%s %s' % (action, source)
+
+
+def replace_file(source, destination):
+    '''
+    Rename source to destination, replacing any existing file (atomically,
+    where the platform allows).
+    '''
+    try:
+        rename(source, destination)
+    except OSError:
+        if not exists(destination):
+            raise
+        remove(destination)
+        rename(source, destination)
+
+
+def split(open_file):
+    '''
+    It is important that this reads the entire file eagerly as the file
+    is closed after being called.  Compressed files are decompressed (see
+    decoded()).
+    '''
+    return EOL.split(''.join(decoded(read_chunks(open_file))))
+
+
+def scan(open_file, quiet=True, fragile=False, stats=None, name=None,
+         since=None):
+    '''
+    Generate the entries in an open file, giving the same results as
+    parse(split(open_file)) but without reading everything into memory.
+    Regular files are memory mapped; other streams are read in chunks.
+    The file should not be closed until the sequence is exhausted.
+    If stats (a Stats) is given then the lines, blocks and bytes read are
+    counted for the stage "parse" and source name.  If since is given then
+    entries dated before then are skipped (see Scanner).
+
+    >>> from StringIO import StringIO
+    >>> list(scan(StringIO('### BEGIN GHETTONET\\r\\n'
+    ...                    '<b>1.2.3.4 a.b</b>\\r\\n')))
+    [<Entry 1.2.3.4:a.b [] []>]
+    '''
+    scanner = Scanner(quiet=quiet, fragile=fragile, cache=PARSED, since=since)
+    data = map_file(open_file)
+    if data is not None:
+        entries = scanner.scan_data(data)
+    else:
+        entries = scanner.scan_chunks(decoded(read_chunks(open_file)))
+    for entry in entries:
+        yield entry
+    scanner.close()
+    if stats is not None:
+        stats.count('parse', name, **scanner.counts(data))
+    if data is not None:
+        data.close()
+
+
+def map_file(open_file):
+    '''
+    Return a read-only memory map of the file, or None if that is not
+    possible (a pipe or an empty file, for example).
+    '''
+    try:
+        return mmap(open_file.fileno(), 0, access=ACCESS_READ)
+    except (AttributeError, ValueError, EnvironmentError):
+        return None
+
+
+def read_chunks(open_file):
+    '''
+    Generate the contents of the open file in pieces of CHUNK bytes.
+    '''
+    while True:
+        chunk = open_file.read(CHUNK)
+        if not chunk:
+            break
+        yield chunk
+
+
+def data_chunks(data):
+    '''
+    Generate data (a string or mmap) in pieces of CHUNK bytes.
+    '''
+    for offset in xrange(0, len(data), CHUNK):
+        yield data[offset:offset+CHUNK]
+
+
+def compression(data):
+    '''
+    The format of compressed data (a string or mmap), found from the magic
+    bytes at the start: one of COMPRESSIONS, or None for plain text.
+
+    >>> compression('\\x1f\\x8b\\x08\\x00'), compression('BZh91AY&SY')
+    ('gzip', 'bz2')
+    >>> compression('### BEGIN GHETTONET'), compression('BZh is not bz2')
+    (None, None)
+    '''
+    for kind in COMPRESSIONS:
+        for (offset, magic) in MAGIC[kind]:
+            if data[offset:offset+len(magic)] != magic:
+                break
+        else:
+            return kind
+    return None
+
+
+def decompressor(kind):
+    '''
+    A new decompressor for the given format (one of COMPRESSIONS).
+    '''
+    if kind == 'gzip':
+        return decompressobj(16 + MAX_WBITS)
+    elif kind == 'bz2':
+        return BZ2Decompressor()
+    elif LZMADecompressor is None:
+        raise Exception('Reading xz needs the lzma module '
+                        '(backports.lzma on Python 2)')
+    else:
+        return LZMADecompressor()
+
+
+def decompress(chunks, kind):
+    '''
+    Generate the contents of chunks (strings) compressed in the given format,
+    one after another if several streams were joined (as by cat).  The 
+    gzip pieces generated are at most CHUNK bytes, so memory use is bounded
+    however well the data compress.
+    '''
+    decoder = decompressor(kind)
+    try:
+        for chunk in chunks:
+            while chunk:
+                if kind == 'gzip':
+                    data = decoder.decompress(chunk, CHUNK)
+                    chunk = decoder.unconsumed_tail
+                else:
+                    try:
+                        (data, chunk) = (decoder.decompress(chunk), '')
+                    except EOFError: # stream ended exactly at a chunk end
+                        decoder = decompressor(kind)
+                        continue
+                if data:
+                    yield data
+                if decoder.unused_data: # another stream follows
+                    chunk = decoder.unused_data # includes any tail
+                    decoder = decompressor(kind)
+        if kind == 'gzip':
+            data = decoder.flush()
+            if data:
+                yield data
+    except (ZlibError, IOError, LZMAError or IOError), error:
+        raise Exception('Bad %s data: %s' % (kind, error))
+
+
+def decoded(chunks):
+    '''
+    Generate chunks (strings), decompressed if the first starts with the 
+    magic bytes of a compressed format (see compression()).
+
+    >>> out = StringIO()
+    >>> compressed = CompressedOutput(out, 'gzip')
+    >>> compressed.write('1.2.3.4 a.com\\n' * 100000)
+    >>> compressed.close()
+    >>> data = out.getvalue()
+    >>> len(data) < 10000, compression(data)
+    (True, 'gzip')
+    >>> pieces = list(decoded(data_chunks(data + data)))
+    >>> max(map(len, pieces)) <= CHUNK, ''.join(pieces).count('a.com')
+    (True, 200000)
+    >>> list(decoded(['plain ', 'text']))
+    ['plain ', 'text']
+    '''
+    chunks = iter(chunks)
+    for first in chunks:
+        kind = compression(first)
+        if kind is None:
+            yield first
+            for chunk in chunks:
+                yield chunk
+        else:
+            for data in decompress(chain([first], chunks), kind):
+                yield data
+        break
+
+
+class CompressedOutput(object):
+    '''
+    A file that compresses what is written to it, in the given format (one
+    of COMPRESSIONS), before writing to out.  Closing finishes the 
+    compressed stream but does not close out.
+    '''
+
+    def __init__(self, out, kind):
+        self.out = out
+        if kind == 'gzip':
+            self.encoder = compressobj(6, DEFLATED, 16 + MAX_WBITS)
+        elif kind == 'bz2':
+            self.encoder = BZ2Compressor()
+        elif LZMACompressor is None:
+            raise Exception('Writing xz needs the lzma module '
+                            '(backports.lzma on Python 2)')
+        else:
+            self.encoder = LZMACompressor()
+
+    def write(self, text):
+        data = self.encoder.compress(text)
+        if data:
+            self.out.write(data)
+
+    def flush(self):
+        pass # flushing the encoder would make the output larger
+
+    def close(self):
+        self.out.write(self.encoder.flush())
+        self.out.flush()
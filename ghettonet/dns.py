@@ -0,0 +1,264 @@
+'''
+A simple DNS responder for the entries (see --dns).
+'''
+
+
+from select import select
+from socket import socket, gethostbyname, AF_INET, SOCK_DGRAM, \
+    error as socket_error
+from struct import pack, unpack
+from sys import stderr
+from time import time
+
+from ghettonet.core import Entry, unpack_ipv4
+
+
+# the number of DNS responses kept by DnsResponder (see respond())
+DNS_ANSWERS = 100000
+
+
+def dns_name(name):
+    '''
+    The DNS wire format of a name (lower case), or None if it is not valid.
+
+    >>> dns_name('www.Example.com')
+    '\\x03www\\x07example\\x03com\\x00'
+    '''
+    labels = name.lower().rstrip('.').split('.')
+    if len(name) > 253 or [label for label in labels 
+                           if not 0 < len(label) < 64]:
+        return None
+    return ''.join(chr(len(label)) + label for label in labels) + '\x00'
+
+
+def dns_query(name, qtype=1, id=0):
+    '''
+    A DNS query (for an A record, by default) as sent by a client.
+    '''
+    return pack('>HHHHHH', id, 0x0100, 1, 0, 0, 0) + dns_name(name) + \
+        pack('>HH', qtype, 1)
+
+
+def parse_upstream(upstream):
+    '''
+    The (address, port) for a HOST[:PORT] string.
+
+    >>> parse_upstream('127.0.0.1:5353'), parse_upstream('127.0.0.1')
+    (('127.0.0.1', 5353), ('127.0.0.1', 53))
+    '''
+    (host, port) = (upstream, 53)
+    if ':' in upstream:
+        (host, port) = upstream.rsplit(':', 1)
+    return (gethostbyname(host), int(port))
+
+
+class DnsResponder(object):
+    '''
+    A small DNS server that answers A queries for the names in the given
+    entries, for use instead of a very large hosts file (which most
+    resolvers search line by line).  Other names are forwarded to the 
+    upstream server ((address, port)), if given, or do not exist.  Other 
+    types of query (AAAA, for example) for known names have no answers.
+
+    Each name is indexed in the DNS wire format, so that queries can be
+    looked up without decoding.  Responses are also kept, indexed by the 
+    query (without the id), so repeated queries need a single dict lookup.
+    Everything runs in a single thread: serve_forever() waits for packets
+    and then handles all that are queued.
+
+    >>> server = DnsResponder([Entry(ipv4='1.2.3.4', names=['a.com'])], 
+    ...                       address=('127.0.0.1', 0))
+    >>> client = socket(AF_INET, SOCK_DGRAM)
+    >>> client.sendto(dns_query('A.com', id=7), server.address)
+    23
+    >>> server.receive()
+    >>> response = client.recv(512)
+    >>> '%d %04x' % unpack('>HH', response[:4]) # id and flags
+    '7 8500'
+    >>> unpack_ipv4(unpack('>I', response[-4:])[0])
+    '1.2.3.4'
+    >>> client.sendto(dns_query('b.com', id=8), server.address)
+    23
+    >>> server.receive()
+    >>> '%d %04x' % unpack('>HH', client.recv(512)[:4]) # NXDOMAIN
+    '8 8503'
+
+    Unknown names are forwarded, and the responses returned:
+
+    >>> forwarder = DnsResponder([], address=('127.0.0.1', 0),
+    ...                          upstream=server.address)
+    >>> client.sendto(dns_query('a.com', id=9), forwarder.address)
+    23
+    >>> forwarder.receive(); server.receive(); forwarder.relay()
+    >>> response = client.recv(512)
+    >>> (unpack('>H', response[:2])[0], 
+    ...  unpack_ipv4(unpack('>I', response[-4:])[0]))
+    (9, '1.2.3.4')
+    >>> for responder in (forwarder, server, client):
+    ...     responder.close()
+    '''
+
+    def __init__(self, entries, address=('127.0.0.1', 53), upstream=None,
+                 ttl=300, timeout=5, quiet=True):
+        self.socket = socket(AF_INET, SOCK_DGRAM)
+        self.socket.bind(address)
+        self.socket.setblocking(0)
+        self.address = self.socket.getsockname()
+        (self.upstream, self.forwarder) = (upstream, None)
+        if upstream is not None:
+            self.forwarder = socket(AF_INET, SOCK_DGRAM)
+            self.forwarder.setblocking(0)
+        (self.ttl, self.timeout, self.quiet) = (ttl, timeout, quiet)
+        (self.pending, self.serial, self.running) = ({}, 0, False)
+        self.load(entries)
+
+    def load(self, entries):
+        '''
+        Index the entries, replacing any already loaded.  Each name maps
+        to the answer record (which refers to the name in the question).
+        '''
+        (names, answers) = ({}, {})
+        for entry in entries:
+            ipv4 = entry._ipv4
+            if not isinstance(ipv4, (int, long)):
+                try:
+                    ipv4 = [int(part) for part in ipv4.split('.')]
+                    if len(ipv4) != 4 or max(ipv4) > 255:
+                        raise ValueError
+                    ipv4 = unpack('>I', pack('BBBB', *ipv4))[0]
+                except ValueError:
+                    if not self.quiet:
+                        print >> stderr, 'Cannot serve %s' % entry.ipv4
+                    continue
+            answer = answers.get(ipv4)
+            if answer is None:
+                answer = answers[ipv4] = pack('>HHHIHI', 0xc00c, 1, 1, 
+                                              self.ttl, 4, ipv4)
+            for name in entry._names:
+                wire = dns_name(name)
+                if wire is not None:
+                    names[wire] = answer
+        (self.names, self.answers) = (names, {})
+
+    def respond(self, data, client):
+        '''
+        The response to the query in data, without the id, or None if the
+        query was forwarded or should be ignored.
+        '''
+        if len(data) < 17:
+            return None
+        (flags, count) = unpack('>HH', data[2:6])
+        if flags & 0x8000: # a response
+            return None
+        header = 0x8400 | flags & 0x0100 | (self.forwarder and 0x0080 or 0)
+        if flags & 0x7800 or count != 1: # not a standard query
+            return pack('>HHHHH', header | 4, 0, 0, 0, 0)
+        end = 12
+        while data[end] != '\x00':
+            if ord(data[end]) > 63 or end > 266: # compressed, or too long
+                return pack('>HHHHH', header | 1, 0, 0, 0, 0)
+            end = end + ord(data[end]) + 1
+            if end + 5 > len(data):
+                return pack('>HHHHH', header | 1, 0, 0, 0, 0)
+        question = data[12:end+5]
+        (qtype, qclass) = unpack('>HH', question[-4:])
+        answer = self.names.get(question[:-4].lower())
+        if answer is None:
+            if self.forwarder is not None:
+                self.forward(data, client)
+                return None
+            response = pack('>HHHHH', header | 3, 1, 0, 0, 0) + question
+        elif qtype in (1, 255) and qclass in (1, 255): # A or ANY
+            response = pack('>HHHHH', header, 1, 1, 0, 0) + question + answer
+        else:
+            response = pack('>HHHHH', header, 1, 0, 0, 0) + question
+        if len(self.answers) >= DNS_ANSWERS:
+            self.answers.clear()
+        self.answers[data[2:]] = response
+        return response
+
+    def receive(self):
+        '''
+        Answer all the queries that are waiting (at most 1000).
+        '''
+        (recvfrom, sendto) = (self.socket.recvfrom, self.socket.sendto)
+        (answers, respond) = (self.answers, self.respond)
+        for count in xrange(1000):
+            try:
+                (data, client) = recvfrom(4096)
+            except socket_error:
+                return
+            response = answers.get(data[2:])
+            if response is None:
+                try:
+                    response = respond(data, client)
+                except IndexError: # truncated
+                    continue
+                if response is None:
+                    continue
+            try:
+                sendto(data[:2] + response, client)
+            except socket_error:
+                pass
+
+    def forward(self, data, client):
+        '''
+        Send the query upstream, with a new id.
+        '''
+        self.serial = (self.serial + 1) & 0xffff
+        self.pending[self.serial] = (client, data[:2], time())
+        try:
+            self.forwarder.sendto(pack('>H', self.serial) + data[2:], 
+                                  self.upstream)
+        except socket_error:
+            del self.pending[self.serial]
+
+    def relay(self):
+        '''
+        Return any responses from upstream to the clients that asked.
+        '''
+        while True:
+            try:
+                (data, server) = self.forwarder.recvfrom(4096)
+            except socket_error:
+                return
+            if server != self.upstream or len(data) < 2:
+                continue
+            query = self.pending.pop(unpack('>H', data[:2])[0], None)
+            if query is not None:
+                try:
+                    self.socket.sendto(query[1] + data[2:], query[0])
+                except socket_error:
+                    pass
+
+    def expire(self):
+        '''
+        Forget forwarded queries that were not answered in time.
+        '''
+        limit = time() - self.timeout
+        for (serial, query) in self.pending.items():
+            if query[2] < limit:
+                del self.pending[serial]
+
+    def serve_forever(self):
+        '''
+        Answer queries until shutdown() is called (from another thread).
+        '''
+        sockets = [self.socket] + filter(None, [self.forwarder])
+        self.running = True
+        while self.running:
+            ready = select(sockets, [], [], 0.5)[0]
+            if self.socket in ready:
+                self.receive()
+            if self.forwarder in ready:
+                self.relay()
+            if self.pending:
+                self.expire()
+
+    def shutdown(self):
+        self.running = False
+
+    def close(self):
+        self.socket.close()
+        if self.forwarder is not None:
+            self.forwarder.close()
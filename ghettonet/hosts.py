@@ -0,0 +1,548 @@
+'''
+Reading, writing and updating hosts files (with backups).
+'''
+
+
+from cPickle import dump, load
+from cStringIO import StringIO
+from gzip import GzipFile
+from hashlib import sha1
+from itertools import chain
+from os import linesep, environ, remove, fdopen, close, makedirs, listdir, \
+    fsync, stat, chmod, chown
+from os.path import exists, isfile, join, dirname
+from platform import system
+from shutil import copyfile, copyfileobj
+from sys import stderr, exc_info
+from tempfile import mkstemp, mkdtemp
+from time import time
+
+from ghettonet.core import CHUNK, Entry, Scanner, map_file, note_access, \
+    replace_file
+from ghettonet.merging import ipv4_key
+
+
+# default paths for hosts file, by platform (please extend/correct)
+DEFAULT_HOSTS = {'Windows': environ.get('SystemRoot', 'C:') + '\system32\drivers\etc\hosts',
+                 'Linux': '/etc/hosts',
+                 'Darwin': '/private/etc/hosts'}
+
+
+def get_hosts_path(path=None):
+    '''
+    Try to work out where the hosts file is located.
+    '''
+    if path is None:
+        path = DEFAULT_HOSTS.get(system())
+    if path is None:
+        raise Exception('Hosts location unknown for %s, please use -p option'
+                        % system())
+    if not exists(path) or not isfile(path):
+        raise Exception('Hosts not at %s, please use -p option' % path)
+    return path
+
+
+def open_hosts(path=None, mode='r', quiet=True):
+    '''
+    Open the local hosts file.
+    '''
+    path = get_hosts_path(path)
+    note_access(path, quiet, 'w' in mode)
+    return open(path, mode)
+
+
+def write(out, entries, erase=False, stats=None, layout=None):
+    '''
+    Write a sequence of Entry instances to the given file.  Entries are 
+    written as they are read (unless layout is given), so a generator of 
+    entries need not fit in memory.
+
+    If erase is True, and there are not entries, we don't write the 
+    header lines.
+
+    If stats (a Stats) is given then the stage "write" is recorded, with
+    the bytes written (the data are written in a single piece, so that they
+    can be counted).  If layout (a Layout) is given then it decides the 
+    order of the entries and how names are split between lines.
+    '''
+    if stats is not None:
+        stats.start('write')
+        block = StringIO()
+        try:
+            write(block, entries, erase=erase, layout=layout)
+            block = block.getvalue()
+            out.write(block)
+        finally:
+            stats.stop()
+        stats.count('write', bytes_written=len(block))
+        return
+    # the first entry is found before anything is written, so that merging
+    # is complete (and any errors are raised) first
+    entries = iter(entries)
+    first = next(entries, None)
+    if first is not None:
+        entries = chain([first], entries)
+    if not erase or first is not None:
+        print >> out, '### BEGIN GHETTONET'
+        print >> out
+        if layout is None:
+            for entry in entries:
+                print >> out, str(entry)
+                print >> out
+        else:
+            for lines in layout.lines(entries):
+                print >> out, linesep.join(lines)
+                print >> out
+        print >> out, '### END GHETTONET'
+
+
+class Layout(object):
+    '''
+    The arrangement of the entries written to a hosts file, for resolvers
+    that search the file line by line (so the names used most should come
+    first, and lines should not be too long).  The output depends only on
+    the entries (and hits), not on the order in which they are given, so
+    that changes between versions of the file are small.
+
+    Names are sorted within each entry by hits (most first), then by name,
+    and split into lines of at most per_line names (None for no limit),
+    each with the entry's date (so that the lines are merged correctly if
+    read again).  The comments are kept with the first line.  Lines are 
+    then ordered by the hits for their first name ("hits"), by their first 
+    name ("name") or by IPv4 ("ipv4").  Hits is a dict from name to the
+    number of times the name is used (see read_hits()).
+
+    >>> entries = [Entry(ipv4='5.6.7.8', names=['c.com', 'b.com', 'a.com'],
+    ...                  comments=['# x']),
+    ...            Entry(ipv4='1.2.3.4', names=['d.com'])]
+    >>> layout = Layout(order='hits', hits={'c.com': 9, 'd.com': 5}, 
+    ...                 per_line=2)
+    >>> for lines in layout.lines(entries):
+    ...     print lines
+    ['# x', '5.6.7.8    c.com a.com']
+    ['1.2.3.4    d.com']
+    ['5.6.7.8    b.com']
+    >>> for lines in Layout(order='ipv4').lines(entries):
+    ...     print lines
+    ['1.2.3.4    d.com']
+    ['# x', '5.6.7.8    a.com b.com c.com']
+    '''
+
+    ORDERS = ('ipv4', 'name', 'hits')
+
+    def __init__(self, order='ipv4', hits=None, per_line=None):
+        if order not in self.ORDERS:
+            raise Exception('Unknown order: %s (use %s)' % 
+                            (order, ', '.join(self.ORDERS)))
+        if order == 'hits' and hits is None:
+            raise Exception('Ordering by hits needs the number of hits '
+                            'for each name')
+        if per_line is not None and per_line < 1:
+            raise Exception('There must be at least one name per line')
+        (self.order, self.hits, self.per_line) = (order, hits or {}, per_line)
+
+    def lines(self, entries):
+        '''
+        Generate the lines (comments, date and address) for each address
+        line, in order.
+        '''
+        (hits, rows) = (self.hits, [])
+        for entry in entries:
+            names = sorted(entry._names, 
+                           key=lambda name: (-hits.get(name, 0), name))
+            ipv4 = ipv4_key(entry._ipv4)
+            step = self.per_line or len(names) or 1
+            for start in xrange(0, len(names), step):
+                part = names[start:start+step]
+                if self.order == 'hits':
+                    key = (-hits.get(part[0], 0), part[0], ipv4, start)
+                elif self.order == 'name':
+                    key = (part[0], ipv4, start)
+                else:
+                    key = (ipv4, start)
+                rows.append((key, entry, part))
+        rows.sort(key=lambda row: row[0])
+        for (key, entry, names) in rows:
+            lines = entry.format_date() + \
+                ['%s    %s' % (entry.ipv4, ' '.join(names))]
+            if key[-1] == 0:
+                lines = entry.format_comments() + lines
+            yield lines
+
+
+def read_hits(path):
+    '''
+    The number of times each name is used, from a file with a count and a
+    name on each line (the output of "sort | uniq -c", for example).  Blank
+    lines and comments are ignored.
+    '''
+    hits = {}
+    source = open(path)
+    try:
+        for line in source:
+            parts = line.split()
+            if not parts or parts[0].startswith('#'):
+                continue
+            try:
+                (count, name) = (int(parts[0]), parts[1].lower().rstrip('.'))
+            except (ValueError, IndexError):
+                raise Exception('Bad line in %s: %s' % (path, line.strip()))
+            hits[name] = hits.get(name, 0) + count
+    finally:
+        source.close()
+    return hits
+
+
+def text_spans(data, quiet=True, end=None):
+    '''
+    The (start, end) offsets of the non-GhettoNet data in the contents of
+    the hosts file (a string or mmap), without any trailing blank lines.
+    If the last line does not end with a newline then the returned flag is
+    True.  If end is given then only the data before end are used, and
+    None is returned if they finish inside a block.
+
+    >>> text_spans('a\\n### BEGIN GHETTONET\\n### END GHETTONET\\n\\n'
+    ...            'b\\n  \\n\\n')
+    ([(0, 2), (40, 43)], False)
+    >>> text_spans('a\\n\\nb')
+    ([(0, 4)], True)
+    >>> text_spans(' \\n')
+    ([], False)
+    >>> print text_spans('### BEGIN GHETTONET\\n### END GHETTONET\\n', end=20)
+    None
+    '''
+    scanner = Scanner(quiet=quiet)
+    for entry in scanner.scan(data, final=True, end=end):
+        pass
+    if end is not None and not scanner.in_text:
+        return None
+    scanner.close()
+    spans = scanner.text
+    while spans:
+        (start, end) = spans[-1]
+        last = end - 1
+        while last >= start and data[last] in ' \t\r\n\f\v':
+            last = last - 1
+        if last < start:
+            spans.pop()
+        else:
+            stop = data.find('\n', last, end)
+            if stop < 0:
+                spans[-1] = (start, end)
+                return (spans, True)
+            spans[-1] = (start, stop + 1)
+            break
+    return (spans, False)
+
+
+def update_hosts(entries, erase=False, hosts_path=None, quiet=True,
+                 backups=None, stats=None, layout=None):
+    '''
+    Replace the GhettoNet data in the hosts file with the given entries,
+    keeping the rest of the file (copied unchanged, apart from trailing 
+    blank lines).  If the contents would not change then nothing is written
+    (and no backup is made); otherwise the existing file is saved in the 
+    backups (a BackupStore, by default in the directory next to the hosts
+    file given by backup_directory()) and the new file is written to a 
+    temporary file that then replaces the original.
+
+    If stats (a Stats) is given then the stage "update_hosts" is recorded,
+    with the bytes read and written.  See write() for layout.
+    '''
+    path = get_hosts_path(path=hosts_path)
+    note_access(path, quiet)
+    hosts = open(path, 'rb')
+    if stats is not None:
+        stats.start('update_hosts', path)
+    try:
+        block = StringIO()
+        write(block, entries, erase=erase, layout=layout)
+        block = block.getvalue()
+        if linesep != '\n':
+            block = block.replace('\n', linesep)
+        data = map_file(hosts)
+        if data is None:
+            data = hosts.read()
+        try:
+            spans = None
+            end = len(data) - len(block)
+            if end >= 0 and data[end:] == block:
+                # probably unchanged, so avoid parsing the existing block
+                spans = text_spans(data, quiet=quiet, end=end)
+            if spans is None:
+                spans = text_spans(data, quiet=quiet)
+            (spans, unterminated) = spans
+            pieces = [(data, start, end) for (start, end) in spans]
+            if unterminated:
+                pieces.append((linesep, 0, len(linesep)))
+            pieces.append((linesep, 0, len(linesep)))
+            pieces.append((block, 0, len(block)))
+            if stats is not None:
+                stats.count('update_hosts', path, bytes_read=len(data))
+            if unchanged(data, pieces):
+                if not quiet:
+                    print >> stderr, 'No change to %s' % path
+                if stats is not None:
+                    stats.count('update_hosts', path, unchanged=1)
+                return
+            if backups is None:
+                backups = BackupStore(backup_directory(path))
+            backups.save(path, quiet=quiet)
+            note_access(path, quiet, write=True)
+            def copy_pieces(out):
+                for (source, start, end) in pieces:
+                    for offset in xrange(start, end, CHUNK):
+                        out.write(source[offset:min(offset + CHUNK, end)])
+            replace_hosts(path, copy_pieces)
+            if stats is not None:
+                stats.count('update_hosts', path, bytes_written=sum(
+                        end - start for (source, start, end) in pieces))
+        finally:
+            if not isinstance(data, str):
+                data.close()
+    finally:
+        hosts.close()
+        if stats is not None:
+            stats.stop()
+
+
+def replace_hosts(path, copy):
+    '''
+    Replace the file at path with the data written by copy (a function 
+    that takes the open file), via a temporary file in the same directory,
+    keeping the original permissions.
+    '''
+    mode = None
+    if exists(path):
+        mode = stat(path)
+    try:
+        (handle, temp) = mkstemp(dir=dirname(path) or '.', 
+                                 prefix='.ghettonet-')
+    except EnvironmentError:
+        raise Exception('The hosts file could not be replaced.  '
+                        'You need to run this program with system '
+                        'rights.  If you do not understand this, '
+                        'DO NOT USE.')
+    try:
+        out = fdopen(handle, 'wb')
+        try:
+            copy(out)
+            out.flush()
+            fsync(out.fileno())
+        finally:
+            out.close()
+        if mode is not None:
+            chmod(temp, mode.st_mode & 07777)
+            try:
+                chown(temp, mode.st_uid, mode.st_gid)
+            except (EnvironmentError, AttributeError):
+                pass
+        replace_file(temp, path)
+    except:
+        (type_, value, traceback) = exc_info()
+        if exists(temp):
+            remove(temp)
+        raise type_, value, traceback
+
+
+def unchanged(data, pieces):
+    '''
+    Check whether the concatenated pieces ((source, start, end) triples) 
+    are identical to data, without building the new contents.
+
+    >>> unchanged('abcd', [('abc', 0, 2), ('xcd', 1, 3)])
+    True
+    >>> unchanged('abcd', [('abc', 0, 2), ('xc', 1, 2)])
+    False
+    '''
+    offset = 0
+    for (source, start, end) in pieces:
+        size = end - start
+        if offset + size > len(data):
+            return False
+        if not (source is data and start == offset) and \
+                data[offset:offset+size] != source[start:end]:
+            return False
+        offset = offset + size
+    return offset == len(data)
+
+
+def backup_directory(path):
+    '''
+    The default location of the backups for the given hosts file.
+    '''
+    return path + '.ghettonet'
+
+
+class BackupStore(object):
+    '''
+    A directory of copies of the hosts file.  Each distinct file is stored
+    once, named by the SHA-1 of the contents, and an index records the 
+    (time, digest, size) of each snapshot, so saving and restoring never 
+    need to search the directory.
+
+    After each save, snapshots beyond the most recent keep, or older than
+    max_age days, are dropped (the most recent is always kept) along with 
+    any files no longer used.  If compress is True then all but the most 
+    recent file are compressed with gzip.
+
+    >>> from shutil import rmtree
+    >>> directory = mkdtemp()
+    >>> hosts = join(directory, 'hosts')
+    >>> store = BackupStore(join(directory, 'backups'), keep=2, 
+    ...                     compress=True)
+    >>> for contents in ('a', 'b', 'a', 'c'):
+    ...     open(hosts, 'w').write(contents)
+    ...     store.save(hosts)
+    >>> [(number, size) for (number, when, digest, size) in store.list()]
+    [(0, 1), (1, 1)]
+    >>> sorted(listdir(store.directory))[0]
+    '84a516841ba77a5b4648de2cd0dfcb30ea46dbb4'
+    >>> sorted(listdir(store.directory))[1:]
+    ['86f7e437faa5a7fce15d1ddcb9eaeaea377667b8.gz', 'INDEX']
+    >>> store.restore(1, hosts)
+    >>> open(hosts).read()
+    'a'
+    >>> rmtree(directory)
+    '''
+
+    def __init__(self, directory, keep=10, max_age=None, compress=False):
+        self.directory = directory
+        self.keep = keep
+        self.max_age = max_age
+        self.compress = compress
+
+    def path(self, digest):
+        '''
+        The file that holds the data for digest, or None if missing.
+        '''
+        path = join(self.directory, digest)
+        if exists(path):
+            return path
+        elif exists(path + '.gz'):
+            return path + '.gz'
+
+    def read_index(self):
+        '''
+        The (time, digest, size) snapshots, most recent first.
+        '''
+        try:
+            source = open(join(self.directory, 'INDEX'), 'rb')
+        except EnvironmentError:
+            return []
+        try:
+            return load(source)
+        finally:
+            source.close()
+
+    def write_index(self, index):
+        (handle, path) = mkstemp(dir=self.directory, suffix='.tmp')
+        destination = fdopen(handle, 'wb')
+        try:
+            dump(index, destination, 2)
+        finally:
+            destination.close()
+        replace_file(path, join(self.directory, 'INDEX'))
+
+    def save(self, path, quiet=True, prune=True):
+        '''
+        Add a snapshot of the file at path.
+        '''
+        if not exists(self.directory):
+            makedirs(self.directory)
+        (digest, size) = (sha1(), 0)
+        source = open(path, 'rb')
+        try:
+            while True:
+                data = source.read(CHUNK)
+                if not data:
+                    break
+                digest.update(data)
+                size = size + len(data)
+        finally:
+            source.close()
+        digest = digest.hexdigest()
+        if not self.path(digest):
+            (handle, temp) = mkstemp(dir=self.directory, suffix='.tmp')
+            close(handle)
+            copyfile(path, temp)
+            replace_file(temp, join(self.directory, digest))
+        if not quiet:
+            print >> stderr, 'Copying %s to %s' % (path, self.path(digest))
+        index = self.read_index()
+        if index and index[0][1] == digest:
+            index.pop(0)
+        index.insert(0, (time(), digest, size))
+        if prune:
+            index = self.prune(index)
+        self.write_index(index)
+
+    def prune(self, index):
+        '''
+        Apply the retention policy to the index, deleting files that are no
+        longer needed and (optionally) compressing older files.
+        '''
+        index = index[:max(1, self.keep or len(index))]
+        if self.max_age is not None:
+            oldest = time() - self.max_age * 24 * 60 * 60
+            index = index[:1] + [snapshot for snapshot in index[1:]
+                                 if snapshot[0] >= oldest]
+        used = set(digest for (when, digest, size) in index)
+        for name in listdir(self.directory):
+            digest = name.split('.')[0]
+            if len(digest) == 40 and digest not in used:
+                remove(join(self.directory, name))
+        if self.compress:
+            for digest in used:
+                path = join(self.directory, digest)
+                if digest != index[0][1] and exists(path):
+                    (handle, temp) = mkstemp(dir=self.directory, 
+                                             suffix='.tmp')
+                    out = fdopen(handle, 'wb')
+                    try:
+                        destination = GzipFile(fileobj=out, mode='wb')
+                        source = open(path, 'rb')
+                        try:
+                            copyfileobj(source, destination, CHUNK)
+                        finally:
+                            source.close()
+                            destination.close()
+                    finally:
+                        out.close()
+                    replace_file(temp, path + '.gz')
+                    remove(path)
+        return index
+
+    def list(self):
+        '''
+        Generate (number, time, digest, size) for each snapshot, most recent
+        first (number 0).
+        '''
+        for (number, (when, digest, size)) in enumerate(self.read_index()):
+            yield (number, when, digest, size)
+
+    def restore(self, number, path, quiet=True):
+        '''
+        Replace the file at path with a snapshot (the current file is saved
+        first, so that the restore can itself be undone).
+        '''
+        index = self.read_index()
+        if number < 0 or number >= len(index):
+            raise Exception('There is no backup %d of %s' % (number, path))
+        digest = index[number][1]
+        if exists(path):
+            self.save(path, quiet=quiet, prune=False)
+        stored = self.path(digest)
+        if not quiet:
+            print >> stderr, 'Restoring %s from %s' % (path, stored)
+        def copy(out):
+            if stored.endswith('.gz'):
+                source = GzipFile(stored, 'rb')
+            else:
+                source = open(stored, 'rb')
+            try:
+                copyfileobj(source, out, CHUNK)
+            finally:
+                source.close()
+        replace_hosts(path, copy)
+        self.write_index(self.prune(self.read_index()))
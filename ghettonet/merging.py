@@ -0,0 +1,1171 @@
+'''
+Merging entries with the same name, and filtering and removing entries.
+'''
+
+
+from bisect import bisect
+from cPickle import dump, load
+from datetime import datetime
+from gc import disable, enable, isenabled
+from heapq import merge as merge_sorted
+from itertools import izip, groupby
+from os import remove, fdopen, listdir
+from shutil import rmtree
+from sys import stderr
+from tempfile import mkstemp, mkdtemp
+
+from ghettonet.core import Entry, REMOVE, REMOVE_IPV4, pack_ipv4, pack_ipv4s, \
+    unpack_ipv4
+
+
+# the approximate memory used by each record in sort_external() (for the
+# records of merge_external()), and the number pickled together
+RECORD_SIZE = 300
+RUN_BATCH = 1000
+
+# the most *.DOMAIN patterns that a FilterPlan matches with endswith()
+MAX_SUFFIXES = 20
+
+
+def merge(entries, quiet=True, merge_names=None, stats=None, budget=None,
+          plan=None):
+    '''
+    Combine entries so that addresses are not duplicated.
+
+    Setting merge_names allows merging logic to be modified.  The default uses
+    dates, then combines everything with the same IPv4, and finally
+    discards duplicates or fails (if quiet=True).  The default is handled 
+    by merge_indexed(), which gives the same results more efficiently, or,
+    if budget (bytes of memory) is given, by merge_external(), which gives
+    the same address for each name (in IPv4 order, though the date and 
+    comments of an entry can differ) without holding them all in memory.
+
+    Any merge_names function takes two arguments (entries, quiet), where all
+    entries have a single, identical name, and should return a list of 
+    merged entries.
+
+    If stats (a Stats) is given then the stage "merge" is recorded, with 
+    any merge_names functions as nested stages.  If plan (a FilterPlan) is
+    given then the merged entries are filtered by it.
+    '''
+    if budget is not None and merge_names is None:
+        merged = merge_external(entries, quiet=quiet, budget=budget, 
+                                stats=stats, plan=plan)
+        if stats is not None:
+            merged = stats.wrap('merge', None, merged)
+        return merged
+    if stats is not None:
+        stats.start('merge')
+        try:
+            if merge_names is None:
+                merged = without_gc(merge_indexed, entries, quiet=quiet,
+                                    stats=stats, plan=plan)
+            else:
+                merged = merge(entries, quiet=quiet, 
+                               merge_names=map(stats.timed, merge_names))
+                if plan is not None:
+                    merged = list(plan.apply(merged, stats=stats))
+        finally:
+            stats.stop()
+        stats.count('merge', entries=len(merged))
+        return merged
+    if merge_names is None:
+        return without_gc(merge_indexed, entries, quiet=quiet, plan=plan)
+    # first, split into separate entries for each name
+    by_name = {}
+    for entry in entries:
+        for name in entry._names:
+            if not skip_name(name, quiet):
+                if name not in by_name:
+                    by_name[name] = []
+                by_name[name].append(entry.single_name(name))
+    # next, try to reduce to a single entry
+    for name in by_name.keys():
+        for merge in merge_names:
+            if len(by_name[name]) > 1:
+                by_name[name] = merge(by_name[name], quiet)
+        if len(by_name[name]) > 1:
+            raise Exception('Multiple entries for %s' % name)
+    # finally, combine by IPv4
+    by_ipv4 = {}
+    for name in by_name.keys():
+        entry = by_name[name][0]
+        if entry.ipv4 not in by_ipv4:
+            by_ipv4[entry.ipv4] = entry
+        else:
+            combine_comments(by_ipv4[entry.ipv4].comments, entry._comments)
+            by_ipv4[entry.ipv4].names.append(name)
+    if plan is not None:
+        return list(plan.apply(by_ipv4.values()))
+    return by_ipv4.values()
+
+
+def without_gc(function, *args, **kargs):
+    '''
+    Call the function with the cyclic garbage collector disabled.  This 
+    avoids repeated collections (which take longer as more objects exist)
+    while building large numbers of objects that contain no cycles.
+    '''
+    enabled = isenabled()
+    disable()
+    try:
+        return function(*args, **kargs)
+    finally:
+        if enabled:
+            enable()
+
+
+def skip_name(name, quiet=True):
+    '''
+    Drop localhost and ipv6 names - going to cause problems and shouldn't
+    ever be there.
+    '''
+    if 'localhost' in name or name.startswith('ipv6-'):
+        if not quiet:
+            print >> stderr, 'Skipping %s' % name
+        return True
+    return False
+
+
+def merge_indexed(entries, quiet=True, stats=None, plan=None):
+    '''
+    The default merge (merge_by_date, merge_same_ipv4 then merge_force) in
+    a single pass over the entries, without cloning an entry for each name.
+
+    An index from each name to its best candidates (those with the most
+    recent date) is built as the entries are read; entries that are not
+    candidates are discarded immediately.  Names with a single candidate
+    (almost all) need no further work, and are combined into the results
+    through a second index, by IPv4.  The results, order and messages are
+    the same as from the general merge().  If stats (a Stats) is given then
+    the entries discarded, merged and in conflict are counted (see
+    merge_candidates()).
+
+    If plan (a FilterPlan) is given then it is applied as the winners are
+    combined: the entry for an address that is dropped is left empty (so
+    that the order of the others is unchanged), and names that are removed
+    are not added.  With stats, the names removed, the entries left with
+    no names, and the names at addresses that are dropped (whose entries
+    are not combined) are counted (for the stage "filter_plan").
+
+    >>> entries = [Entry(ipv4='1.2.3.4', names=['a', 'b'], comments=['# x']),
+    ...            Entry(ipv4='1.2.3.4', names=['b'], comments=['## y']),
+    ...            Entry(ipv4='5.6.7.8', names=['c'], date=datetime(2010,1,1)),
+    ...            Entry(ipv4='5.6.7.9', names=['c'])]
+    >>> sorted(merge_indexed(entries), key=lambda e: e.ipv4)
+    [<Entry 1.2.3.4:a;b [] ['# x', '## y']>, <Entry 5.6.7.8:c ['## DATE 2010-01-01 00:00:00'] []>]
+    >>> policy = [merge_by_date, merge_same_ipv4, merge_force]
+    >>> map(repr, merge_indexed(entries)) == \\
+    ...     map(repr, merge(entries, merge_names=policy))
+    True
+    '''
+    # each name maps to an entry or, if there are several, to a list
+    # [date, candidates, count]
+    by_name = {}
+    for entry in entries:
+        date = entry.date
+        for name in entry._names:
+            if skip_name(name, quiet):
+                continue
+            record = by_name.get(name)
+            if record is None:
+                by_name[name] = entry
+                continue
+            if not isinstance(record, list):
+                record = by_name[name] = [record.date, [record], 1]
+            record[2] = record[2] + 1
+            if date is None:
+                if record[0] is None:
+                    record[1].append(entry)
+            elif record[0] is None or date > record[0]:
+                (record[0], record[1]) = (date, [entry])
+            elif date == record[0]:
+                record[1].append(entry)
+    # combine by IPv4 (packed, when possible), keeping the entries in the
+    # order created, the first comments merged for each IPv4 and, if there
+    # are others, (stripped comments, ids of comment tuples already merged)
+    (by_ipv4, created, first, known) = ({}, [], {}, {})
+    if plan is not None and not plan:
+        plan = None
+    (dropped, removed, skipped) = (set(), 0, 0)
+    for (name, record) in by_name.iteritems():
+        if isinstance(record, list):
+            (winner, comments) = merge_candidates(name, record, quiet, 
+                                                  stats)
+        else:
+            (winner, comments) = (record, record._comments)
+        key = winner._ipv4
+        merged = by_ipv4.get(key)
+        if merged is None:
+            merged = by_ipv4[key] = Entry.__new__(Entry)
+            created.append(merged)
+            if plan is not None and plan.drops(key):
+                (merged._ipv4, merged._names) = (key, [])
+                dropped.add(key)
+                skipped = skipped + 1
+                continue
+            (merged._ipv4, merged._names, merged._comments) = \
+                (key, [name], list(comments))
+            (merged.date, merged.date_extra) = \
+                (winner.date, winner.date_extra)
+            first[key] = comments
+            if plan is not None and not plan.keeps(name, merged.date):
+                merged._names = []
+                removed = removed + 1
+            continue
+        if plan is None:
+            merged._names.append(name)
+        elif key in dropped:
+            skipped = skipped + 1
+            continue
+        elif plan.keeps(name, merged.date):
+            merged._names.append(name)
+        else:
+            removed = removed + 1
+        if comments is first[key]:
+            continue
+        state = known.get(key)
+        if state is None:
+            state = known[key] = (set(map(strip_comment, merged._comments)),
+                                  set([id(first[key])]))
+        if comments is winner._comments: # shared, so id is unique
+            if id(comments) in state[1]:
+                continue
+            state[1].add(id(comments))
+        combine_comments(merged._comments, comments, known=state[0])
+    # the final ordering is the same as from the general merge()
+    by_ipv4 = {}
+    for entry in created:
+        by_ipv4[entry.ipv4] = entry
+    if plan is None:
+        return by_ipv4.values()
+    merged = [entry for entry in by_ipv4.itervalues() if entry._names]
+    if stats is not None:
+        stats.count('filter_plan', names_removed=removed, 
+                    entries_removed=len(by_ipv4) - len(merged) - len(dropped),
+                    not_combined=skipped)
+    return merged
+
+
+def merge_external(entries, quiet=True, budget=64 << 20, stats=None, 
+                   plan=None):
+    '''
+    Generate merged entries, in IPv4 order, using about budget bytes of 
+    memory however many entries are given.  Each name gets the same 
+    address as from merge_indexed(), but an entry's date and comments can
+    differ (see below).
+
+    A record for each name of each entry is sorted by name (and position)
+    with sort_external(), so that the entries for each name can be resolved
+    in turn by merge_candidates(); the winners are then sorted by IPv4 (and
+    name) and combined.  The names of each result, and so the order of
+    their comments, are in name order, as are any messages.  An entry's 
+    date (and its first comments) come from its first name in that order,
+    while merge_indexed() takes them from the first name in the order of
+    its index (a dict), which cannot be followed without holding every 
+    name; so when the names for an address have different dates the two
+    can give different dates (and comments in a different order), and 
+    removals (which compare with the entry's date) can differ too.  Nothing is
+    given until all the names are resolved, so a conflict (when quiet) 
+    raises an exception before any entry is given.  A plan (a FilterPlan)
+    is applied as in merge_indexed(), except that the winners at addresses
+    that are dropped are discarded before they are sorted.
+
+    >>> entries = [Entry(ipv4='5.6.7.8', names=['c'], date=datetime(2010,1,1)),
+    ...            Entry(ipv4='1.2.3.4', names=['b', 'a'], comments=['# x']),
+    ...            Entry(ipv4='1.2.3.4', names=['b'], comments=['## y']),
+    ...            Entry(ipv4='5.6.7.9', names=['c'])]
+    >>> list(merge_external(entries, budget=1000))
+    [<Entry 1.2.3.4:a;b [] ['# x', '## y']>, <Entry 5.6.7.8:c ['## DATE 2010-01-01 00:00:00'] []>]
+    >>> entries = [Entry(ipv4='1.2.3.4', names=['x.org'], 
+    ...                  date=datetime(2010,1,1)),
+    ...            Entry(ipv4='1.2.3.4', names=['y.org'], 
+    ...                  date=datetime(2011,1,1))]
+    >>> list(merge_external(entries, budget=1000))
+    [<Entry 1.2.3.4:x.org;y.org ['## DATE 2010-01-01 00:00:00'] []>]
+    >>> merge_indexed(entries)
+    [<Entry 1.2.3.4:y.org;x.org ['## DATE 2011-01-01 00:00:00'] []>]
+    '''
+    dropping = plan is not None and len(plan.ranges) > 0
+    counts = {'entries_removed': 0, 'names_removed': 0, 'not_combined': 0}
+    directory = mkdtemp(prefix='ghettonet-')
+    try:
+        def names():
+            for (position, entry) in enumerate(entries):
+                for name in entry._names:
+                    if not skip_name(name, quiet):
+                        yield (name, position, entry._ipv4, entry.date, 
+                               entry.date_extra, entry._comments)
+        def winners():
+            for (name, records) in groupby(sort_external(names(), budget,
+                                                         directory),
+                                           lambda record: record[0]):
+                records = list(records)
+                if len(records) == 1:
+                    (ignored, ignored, ipv4, date, date_extra, comments) = \
+                        records[0]
+                    if dropping and plan.drops(ipv4):
+                        counts['not_combined'] = counts['not_combined'] + 1
+                        continue
+                    yield (ipv4_key(ipv4), name, date, date_extra, comments)
+                    continue
+                # the candidates, as in merge_indexed()
+                (date, candidates) = (None, [])
+                for record in records:
+                    entry = Entry.__new__(Entry)
+                    (entry._names, entry._ipv4, entry.date, entry.date_extra,
+                     entry._comments) = ((name,),) + record[2:]
+                    if entry.date is None:
+                        if date is None:
+                            candidates.append(entry)
+                    elif date is None or entry.date > date:
+                        (date, candidates) = (entry.date, [entry])
+                    elif entry.date == date:
+                        candidates.append(entry)
+                (winner, comments) = merge_candidates(
+                    name, (date, candidates, len(records)), quiet, stats)
+                if dropping and plan.drops(winner._ipv4):
+                    counts['not_combined'] = counts['not_combined'] + 1
+                    continue
+                yield (ipv4_key(winner._ipv4), name, winner.date, 
+                       winner.date_extra, comments)
+        filtering = None
+        for (ipv4, records) in groupby(sort_external(winners(), budget, 
+                                                     directory),
+                                       lambda record: record[0]):
+            if filtering is None: # all the removals are known now
+                filtering = plan is not None and bool(plan)
+            merged = None
+            for (ignored, name, date, date_extra, comments) in records:
+                if merged is None:
+                    merged = Entry.__new__(Entry)
+                    (merged._ipv4, merged._names, merged._comments) = \
+                        (ipv4[1], [], list(comments))
+                    (merged.date, merged.date_extra) = (date, date_extra)
+                    known = set(map(strip_comment, merged._comments))
+                else:
+                    combine_comments(merged._comments, comments, known=known)
+                if not filtering or plan.keeps(name, merged.date):
+                    merged._names.append(name)
+                else:
+                    counts['names_removed'] = counts['names_removed'] + 1
+            if merged._names:
+                yield merged
+            else:
+                counts['entries_removed'] = counts['entries_removed'] + 1
+        if plan and stats is not None:
+            stats.count('filter_plan', **counts)
+    finally:
+        rmtree(directory, ignore_errors=True)
+
+
+def ipv4_key(ipv4):
+    '''
+    A key that orders the addresses of entries (packed, or strings when 
+    they cannot be packed), numerically where possible.
+    '''
+    if isinstance(ipv4, (int, long)):
+        return (0, ipv4)
+    return (1, ipv4)
+
+
+def sort_external(records, budget, directory):
+    '''
+    Generate the records (tuples) in order, holding about budget bytes of
+    them in memory (see RECORD_SIZE).  When more are
+    given they are sorted in runs that are pickled to files in directory,
+    and the runs are then merged.
+
+    >>> from shutil import rmtree
+    >>> directory = mkdtemp()
+    >>> records = [(str(n % 97), n) for n in range(1000)]
+    >>> ordered = sort_external(records, 1000, directory)
+    >>> first = next(ordered)
+    >>> len(listdir(directory)) > 1
+    True
+    >>> [first] + list(ordered) == sorted(records)
+    True
+    >>> listdir(directory)
+    []
+    >>> rmtree(directory)
+    '''
+    (run, size, runs) = ([], 0, [])
+    for record in records:
+        run.append(record)
+        size = size + RECORD_SIZE
+        if size > budget:
+            run.sort()
+            runs.append(write_run(run, directory))
+            (run, size) = ([], 0)
+    run.sort()
+    if not runs:
+        for record in run:
+            yield record
+        return
+    for record in merge_sorted(*(map(read_run, runs) + [run])):
+        yield record
+
+
+def write_run(records, directory):
+    '''
+    Pickle the records to a new file in directory, in batches (so that 
+    values shared between nearby records are stored once), and return 
+    the path.
+    '''
+    (handle, path) = mkstemp(dir=directory, suffix='.run')
+    out = fdopen(handle, 'wb')
+    try:
+        for start in xrange(0, len(records), RUN_BATCH):
+            dump(records[start:start+RUN_BATCH], out, 2)
+    finally:
+        out.close()
+    return path
+
+
+def read_run(path):
+    '''
+    Generate the records written by write_run() to path, reading a batch
+    at a time, and then delete the file.
+    '''
+    source = open(path, 'rb')
+    try:
+        while True:
+            try:
+                batch = load(source)
+            except EOFError:
+                break
+            for record in batch:
+                yield record
+    finally:
+        source.close()
+    remove(path)
+
+
+def merge_candidates(name, record, quiet=True, stats=None):
+    '''
+    Resolve the candidates for a name in merge_indexed(), returning the 
+    winning entry and the merged comments.  This does the work of 
+    merge_by_date (messages only, as the candidates are already known),
+    merge_same_ipv4 and merge_force.
+
+    If stats (a Stats) is given then the old entries discarded, the 
+    entries merged with the same IPv4, and the conflicting IPv4 addresses
+    discarded are counted (for the stage "merge").
+    '''
+    (date, candidates, count) = record
+    if stats is not None:
+        stats.count('merge', discarded=count - len(candidates))
+    if not quiet and date is not None:
+        n = count - len(candidates)
+        if n == 1:
+            noun = 'entry'
+        else:
+            noun = 'entries'
+        print >> stderr, 'Discarded %d old %s for %s' % (n, noun, name)
+    if len(candidates) == 1:
+        return (candidates[0], candidates[0]._comments)
+    # groups of [ipv4, entry, comments, known, count]
+    groups = []
+    for entry in sorted(candidates, key=lambda e: e.ipv4):
+        ipv4 = entry.ipv4
+        if groups and groups[-1][0] == ipv4:
+            group = groups[-1]
+            combine_comments(group[2], entry._comments, known=group[3])
+            group[4] = group[4] + 1
+        else:
+            comments = list(entry._comments)
+            groups.append([ipv4, entry, comments, 
+                           set(map(strip_comment, comments)), 1])
+    if stats is not None:
+        stats.count('merge', merged=len(candidates) - len(groups), 
+                    conflicts=len(groups) - 1)
+    if not quiet:
+        for (ipv4, entry, comments, stripped, n) in groups:
+            if n > 1:
+                print >> stderr, 'Merged %d entries with IPv4 %s for %s' % \
+                    (n - 1, ipv4, name)
+    (ipv4, winner, merged, stripped, n) = groups[0]
+    if len(groups) > 1:
+        if quiet:
+            raise Exception('Conflicting IPv4 addresses (%s) for %s' % \
+                (','.join(map(lambda g: g[0], groups)), name))
+        for (ipv4, entry, comments, ignored, n) in groups[1:]:
+            print >> stderr, 'WARNING: Discarding %s as conflict for %s' % \
+                (ipv4, name)
+            combine_comments(merged, comments + ['## CONFLICT: %s' % ipv4], 
+                             known=stripped)
+    return (winner, merged)
+
+
+def merge_by_date(entries, quiet=True):
+    '''
+    Merge entries so that the most recent date wins.
+
+    >>> merge_by_date([Entry(date=datetime(2009,1,1), names=['x']),
+    ...                Entry(date=datetime(2010,1,1), names=['x'])])
+    [<Entry None:x ['## DATE 2010-01-01 00:00:00'] []>]
+    >>> merge_by_date([Entry(date=datetime(2010,1,1), names=['x']),
+    ...                Entry(date=datetime(2009,1,1), names=['x'])])
+    [<Entry None:x ['## DATE 2010-01-01 00:00:00'] []>]
+    >>> merge_by_date([Entry(date=datetime(2010,1,1), names=['x']),
+    ...                Entry(date=datetime(2010,1,1), names=['x'])])
+    [<Entry None:x ['## DATE 2010-01-01 00:00:00'] []>, <Entry None:x ['## DATE 2010-01-01 00:00:00'] []>]
+    '''
+    if entries:
+        assert reduce(lambda same, e: same and len(e._names) == 1,
+                      entries, True), 'Multiple names'
+    else:
+        return entries
+    with_dates = filter(lambda e: e.date != None, entries)
+    if not with_dates:
+        return entries
+    with_dates.sort(key=lambda e: e.date, reverse=True)
+    with_dates = filter(lambda e: e.date == with_dates[0].date, with_dates)
+    if not quiet:
+        n = len(entries) - len(with_dates)
+        if n == 1:
+            noun = 'entry'
+        else:
+            noun = 'entries'
+        print >> stderr, 'Discarded %d old %s for %s' % \
+            (n, noun, with_dates[0]._names[0])
+    return with_dates
+
+
+def merge_same_ipv4(entries, quiet=True):
+    '''
+    Merge entries (all with identical dates) by ipv4 address.
+
+    >>> merge_same_ipv4([Entry(ipv4='1.2', names=['x']), 
+    ...                  Entry(ipv4='1.3', names=['x'])])
+    [<Entry 1.2:x [] []>, <Entry 1.3:x [] []>]
+    >>> merge_same_ipv4([Entry(ipv4='1.2', names=['x']), 
+    ...                  Entry(ipv4='1.2', names=['x'])])
+    [<Entry 1.2:x [] []>]
+    >>> merge_same_ipv4([Entry(ipv4='1.2', names=['x'], comments=['a', 'b']), 
+    ...                  Entry(ipv4='1.2', names=['x'], comments=['a', 'c'])])
+    [<Entry 1.2:x [] ['a', 'b', 'c']>]
+    >>> merge_same_ipv4([Entry(ipv4='1.2', names=['x'], comments=['a', 'b']), 
+    ...                  Entry(ipv4='1.2', names=['x'], comments=['#a', 'c'])])
+    [<Entry 1.2:x [] ['a', 'b', 'c']>]
+    '''
+    if entries:
+        assert reduce(lambda same, e: same and len(e._names) == 1,
+                      entries, True), 'Multiple names'
+        assert reduce(lambda same, e: same and e.date == entries[0].date,
+                      entries, True), 'Dates vary'
+    else:
+        return entries
+    entries.sort(key=lambda e: e.ipv4)
+    def groups():
+        ipv4, group = entries[0].ipv4, []
+        for entry in entries:
+            if ipv4 != entry.ipv4:
+                yield group
+                ipv4, group = entry.ipv4, [entry]
+            else:
+                group.append(entry)
+        yield group
+    def combine():
+        for group in groups():
+            merged = group[0]
+            known = set(map(strip_comment, merged._comments))
+            for other in group[1:]:
+                combine_comments(merged.comments, other._comments, known=known)
+            if not quiet and len(group) > 1:
+                print >> stderr, 'Merged %d entries with IPv4 %s for %s' % \
+                    (len(group) - 1, merged.ipv4, merged._names[0])
+            yield merged
+    return list(combine())
+
+
+def strip_comment(comment):
+    '''
+    Remove all excess text and prefixes from a comment.
+
+    >>> strip_comment('a b')
+    'a b'
+    >>> strip_comment('##  a b  ')
+    'a b'
+    >>> strip_comment(' ## # a b  ')
+    'a b'
+    >>> strip_comment(' ##    ')
+    ''
+    '''
+    return comment.strip().lstrip('# ')
+
+
+def combine_comments(merged, other, known=None):
+    '''
+    Copy non-duplicate comments from other to merged.  Note that the first
+    two arguments are the lists of comments (the first is mustated), and not
+    Enrty instances.
+
+    >>> combine_comments(['a', 'b'], ['a', 'c'])
+    ['a', 'b', 'c']
+    '''
+    if known is None:
+        known = set(map(strip_comment, merged))
+    for comment in other:
+        stripped = strip_comment(comment)
+        if stripped not in known:
+            known.add(stripped)
+            merged.append(comment)
+    return merged
+
+
+def merge_force(entries, quiet=True):
+    '''
+    Force entries to agree by marking some as duplicates.
+
+    >>> merge_force([Entry(ipv4='1.2', names=['x'], comments=['a', 'b']), 
+    ...              Entry(ipv4='1.3', names=['x'], comments=['a', 'c'])])
+    Traceback (most recent call last):
+    Exception: Conflicting IPv4 addresses (1.2,1.3) for x
+    >>> merge_force([Entry(ipv4='1.2', names=['x'], comments=['a', 'b']), 
+    ...              Entry(ipv4='1.3', names=['x'], comments=['a', 'c'])], 
+    ...             quiet=False)
+    [<Entry 1.2:x [] ['a', 'b', 'c', '## CONFLICT: 1.3']>]
+    >>> merge_force([Entry(ipv4='1.2', names=['x'], comments=['a', 'b',
+    ...                  '## CONFLICT: 1.3']), 
+    ...              Entry(ipv4='1.3', names=['x'], comments=['a', 'c'])], 
+    ...             quiet=False)
+    [<Entry 1.2:x [] ['a', 'b', '## CONFLICT: 1.3', 'c']>]
+    '''
+    if entries:
+        assert reduce(lambda same, e: same and len(e._names) == 1,
+                      entries, True), 'Multiple names'
+        assert reduce(lambda same, e: same and e.date == entries[0].date,
+                      entries, True), 'Dates vary'
+        assert len(set(map(lambda e: e.ipv4, entries))) == len(entries), \
+            'IPv4 are not all distinct'
+    else:
+        return entries
+    merged = entries[0]
+    # if being used silently, fail
+    if quiet:
+        raise Exception('Conflicting IPv4 addresses (%s) for %s' % \
+            (','.join(map(lambda e: e.ipv4, entries)), merged._names[0]))
+    known = set(map(strip_comment, merged._comments))
+    for other in entries[1:]:
+        print >> stderr, 'WARNING: Discarding %s as conflict for %s' % \
+            (other.ipv4, merged._names[0])
+        # avoid duplicates by adding conflict to comments before merge
+        other_comments = list(other._comments)
+        other_comments.append('## CONFLICT: %s' % other.ipv4)
+        combine_comments(merged.comments, other_comments, known=known)
+    return [merged]
+
+
+def skip_older(entries, since):
+    '''
+    Generate the entries that are not dated before since (undated entries
+    are kept).  If since is None then all entries are given.
+    '''
+    if since is None:
+        for entry in entries:
+            yield entry
+    else:
+        for entry in entries:
+            if entry.date is None or entry.date >= since:
+                yield entry
+
+
+def split_removals(entries, removals):
+    '''
+    Generate the entries that do not remove names (those without the 
+    comment REMOVE), adding the names that are removed to removals (a 
+    dict from name to the most recent date of removal, or None if none
+    are dated).  See apply_removals().
+    '''
+    for entry in entries:
+        if REMOVE not in entry._comments:
+            yield entry
+            continue
+        date = entry.date
+        for name in entry._names:
+            if name not in removals or (date is not None and 
+                                        (removals[name] is None or 
+                                         date > removals[name])):
+                removals[name] = date
+
+
+def apply_removals(removals, entries):
+    '''
+    Drop the names in removals (from split_removals()) from merged entries,
+    unless the entry is more recent than the removal (an undated removal
+    drops only undated entries), giving the entries that still have names
+    (as they are read, so that a merge can be streamed).
+
+    >>> removals = {}
+    >>> entries = list(split_removals([
+    ...     Entry(ipv4='1.2.3.4', names=['a.com', 'b.com'], 
+    ...           date=datetime(2010, 1, 1)),
+    ...     Entry(ipv4='5.6.7.8', names=['c.com'], date=datetime(2010, 3, 1)),
+    ...     Entry(ipv4=REMOVE_IPV4, names=['a.com', 'c.com'], 
+    ...           date=datetime(2010, 2, 1), comments=[REMOVE])], removals))
+    >>> list(apply_removals(removals, merge(entries)))
+    [<Entry 1.2.3.4:b.com ['## DATE 2010-01-01 00:00:00'] []>, <Entry 5.6.7.8:c.com ['## DATE 2010-03-01 00:00:00'] []>]
+    '''
+    if not removals:
+        return entries
+    def kept():
+        for entry in entries:
+            date = entry.date
+            names = [name for name in entry._names 
+                     if name not in removals or 
+                     (date is not None and (removals[name] is None or 
+                                            date > removals[name]))]
+            if len(names) < len(entry._names):
+                entry.names = names
+            if names:
+                yield entry
+    return kept()
+
+
+def delta(old, new, date=None):
+    '''
+    The entries that change old into new (both sequences of merged 
+    entries): those in new whose names are not in old with the same 
+    address, date and comments, followed by entries (one for each old 
+    address, at REMOVE_IPV4, with the comment REMOVE and the given date)
+    for the names in old that are not in new.  See apply_removals().
+    Comments are compared as they are written (without leading blank 
+    lines) and stripped (see strip_comment()), so old can be read back 
+    from a file written by an earlier run.
+
+    >>> old = [Entry(ipv4='1.2.3.4', names=['a.com', 'b.com']), 
+    ...        Entry(ipv4='5.6.7.8', names=['c.com'])]
+    >>> new = [Entry(ipv4='1.2.3.4', names=['a.com']),
+    ...        Entry(ipv4='5.6.7.9', names=['c.com', 'd.com'], 
+    ...              date=datetime(2010, 1, 1))]
+    >>> for entry in delta(old, new, date=datetime(2010, 1, 2)):
+    ...     print entry
+    ## DATE 2010-01-01 00:00:00
+    5.6.7.9    c.com d.com
+    ## REMOVE
+    ## DATE 2010-01-02 00:00:00
+    0.0.0.0    b.com
+    >>> from cStringIO import StringIO
+    >>> from ghettonet.core import scan
+    >>> from ghettonet.hosts import write
+    >>> new = [Entry(ipv4='1.2.3.4', names=['a.com'], comments=['# one']),
+    ...        Entry(ipv4='5.6.7.8', names=['c.com'])]
+    >>> out = StringIO()
+    >>> write(out, new)
+    >>> old = merge(scan(StringIO(out.getvalue())))
+    >>> sorted(entry.comments for entry in old)
+    [[''], ['', '# one']]
+    >>> delta(old, new)
+    []
+    '''
+    def compared(entry):
+        return (entry._ipv4, entry.date, entry.date_extra, 
+                tuple(map(strip_comment, entry.format_comments())))
+    previous = {}
+    for entry in old:
+        state = compared(entry)
+        for name in entry._names:
+            previous[name] = state
+    changes = []
+    for entry in new:
+        state = compared(entry)
+        names = [name for name in entry._names 
+                 if previous.pop(name, None) != state]
+        if len(names) == len(entry._names):
+            changes.append(entry)
+        elif names:
+            changes.append(entry.clone(names=names))
+    by_ipv4 = {}
+    for (name, state) in previous.iteritems():
+        by_ipv4.setdefault(state[0], []).append(name)
+    for ipv4 in sorted(by_ipv4):
+        changes.append(Entry(ipv4=REMOVE_IPV4, names=sorted(by_ipv4[ipv4]),
+                             date=date, comments=[REMOVE]))
+    return changes
+
+
+class AddressRanges(object):
+    '''
+    A set of IPv4 addresses, given as addresses and CIDR blocks, held as
+    sorted, disjoint intervals of 32 bit integers so that testing an 
+    address takes O(log n) time however many ranges there are.  The 
+    addresses are packed together (see pack_ipv4s()) and all that are not
+    valid are reported.  Host bits in a CIDR block are ignored.
+
+    >>> ranges = AddressRanges(['10.0.0.0/8', '1.2.3.4', '10.1.0.0/16', 
+    ...                         '1.2.3.5/31', '01.2.3.4'])
+    >>> ranges.intervals()
+    [('1.2.3.4', '1.2.3.5'), ('10.0.0.0', '10.255.255.255')]
+    >>> [address in ranges for address in 
+    ...  ('10.20.30.40', '1.2.3.6', '01.2.3.4', '9.255.255.255')]
+    [True, False, True, False]
+    >>> AddressRanges(['1.2.3.0/33', '1.2.3.4', '1.2.3.256'])
+    Traceback (most recent call last):
+      ...
+    Exception: Bad addresses to remove: 1.2.3.0/33, 1.2.3.256
+    '''
+
+    def __init__(self, addresses=()):
+        addresses = [address.strip() for address in addresses]
+        (dotted, sizes, bad) = ([], [], [])
+        for address in addresses:
+            (address, slash, bits) = address.partition('/')
+            dotted.append(address)
+            if not slash:
+                sizes.append(1)
+            elif bits.isdigit() and int(bits) <= 32:
+                sizes.append(1 << 32 - int(bits))
+            else:
+                sizes.append(1)
+                bad.append(len(dotted) - 1)
+        (packed, invalid) = pack_ipv4s(dotted)
+        bad = sorted(set(bad + [index for (index, address) in invalid]))
+        if bad:
+            raise Exception('Bad addresses to remove: %s%s' % (
+                    ', '.join(addresses[index] for index in bad[:10]),
+                    len(bad) > 10 and ' (%d in all)' % len(bad) or ''))
+        intervals = []
+        for (start, size) in izip(packed, sizes):
+            start = start & ~(size - 1)
+            intervals.append((start, start + size - 1))
+        (self.starts, self.ends) = ([], [])
+        for (start, end) in sorted(intervals):
+            if self.ends and start <= self.ends[-1] + 1:
+                self.ends[-1] = max(self.ends[-1], end)
+            else:
+                self.starts.append(start)
+                self.ends.append(end)
+
+    def __contains__(self, address):
+        packed = pack_ipv4(address)
+        return packed is not None and self.contains_packed(packed)
+
+    def contains_packed(self, packed):
+        index = bisect(self.starts, packed) - 1
+        return index >= 0 and packed <= self.ends[index]
+
+    def __len__(self):
+        return len(self.starts)
+
+    def intervals(self):
+        '''
+        The intervals, as pairs of dotted addresses.
+        '''
+        return [(unpack_ipv4(start), unpack_ipv4(end)) 
+                for (start, end) in izip(self.starts, self.ends)]
+
+
+def read_addresses(path):
+    '''
+    The addresses and CIDR blocks in a file, one at the start of each line
+    (so a hosts file can be used).  Blank lines and comments are ignored.
+    '''
+    addresses = []
+    source = open(path)
+    try:
+        for line in source:
+            parts = line.split()
+            if parts and not parts[0].startswith('#'):
+                addresses.append(parts[0])
+    finally:
+        source.close()
+    return addresses
+
+
+def filter_addresses(ipv4s, entries, stats=None):
+    '''
+    Filter entries to exclude any addresses given in the list (addresses 
+    or CIDR blocks, or an AddressRanges).  If stats (a Stats) is given then
+    the entries removed are counted (the time is recorded if the result is
+    wrapped with Stats.wrap()).
+
+    >>> [entry.ipv4 for entry in filter_addresses(['10.0.0.0/8'], 
+    ...     [Entry(ipv4='10.1.2.3', names=['a.com']), 
+    ...      Entry(ipv4='11.1.2.3', names=['b.com'])])]
+    ['11.1.2.3']
+    '''
+    if not isinstance(ipv4s, AddressRanges):
+        ipv4s = AddressRanges(ipv4s)
+    if not ipv4s:
+        for entry in entries:
+            yield entry
+        return
+    contains = ipv4s.contains_packed
+    for entry in entries:
+        ipv4 = entry._ipv4
+        if ipv4.__class__ is int or ipv4.__class__ is long:
+            removed = contains(ipv4)
+        else:
+            removed = ipv4 in ipv4s
+        if not removed:
+            yield entry
+        elif stats is not None:
+            stats.count('filter_addresses', removed=1)
+
+
+class NameIndex(object):
+    '''
+    An index of the names in merged entries, as a trie of reversed labels
+    (so that all the names under a domain are together), supporting 
+    lookup, listing and removal by name or by domain (a pattern of the 
+    form *.DOMAIN matches every name under DOMAIN, but not DOMAIN itself).
+    Each operation takes time in proportion to the number of names found,
+    not the number indexed.
+
+    Each node is a dict from label to child node; a name is marked by the
+    entry under the key None, or by the entry in place of the node when 
+    there are no names below it.
+
+    >>> index = NameIndex(merge([
+    ...     Entry(ipv4='1.2.3.4', names=['example.org', 'www.example.org']),
+    ...     Entry(ipv4='5.6.7.8', names=['a.b.example.org', 'c.com'])]))
+    >>> index.get('WWW.example.org')
+    <Entry 1.2.3.4:example.org;www.example.org [] []>
+    >>> [name for (name, entry) in index.find('*.example.org')]
+    ['a.b.example.org', 'www.example.org']
+    >>> index.remove('*.b.example.org')
+    ['a.b.example.org']
+    >>> sorted(index.entries(), key=lambda entry: entry.ipv4)
+    [<Entry 1.2.3.4:example.org;www.example.org [] []>, <Entry 5.6.7.8:c.com [] []>]
+    '''
+
+    def __init__(self, entries=()):
+        (self.root, self.all) = ({}, [])
+        without_gc(map, self.add, entries)
+
+    def add(self, entry):
+        '''
+        Index the names of the entry (replacing any earlier entries for the
+        same names).
+        '''
+        self.all.append(entry)
+        for name in entry._names:
+            labels = name.split('.')
+            labels.reverse()
+            (node, first) = (self.root, labels.pop())
+            for label in labels:
+                child = node.get(label)
+                if child is None:
+                    child = node[label] = {}
+                elif type(child) is not dict:
+                    child = node[label] = {None: child}
+                node = child
+            child = node.get(first)
+            if type(child) is dict:
+                child[None] = entry
+            else:
+                node[first] = entry
+
+    def parse(self, pattern):
+        '''
+        The reversed labels of a name or *.DOMAIN pattern, and whether
+        names under the domain are wanted.
+        '''
+        pattern = pattern.lower().rstrip('.')
+        under = pattern.startswith('*.')
+        if under:
+            pattern = pattern[2:]
+        return (list(reversed(pattern.split('.'))), under)
+
+    def path(self, labels):
+        '''
+        The nodes (or entry, last) along the path to the labels, or None
+        if there is no such path.
+        '''
+        nodes = [self.root]
+        for label in labels:
+            if not isinstance(nodes[-1], dict) or label not in nodes[-1]:
+                return None
+            nodes.append(nodes[-1][label])
+        return nodes
+
+    def get(self, name):
+        '''
+        The entry for the name, or None.
+        '''
+        nodes = self.path(self.parse(name)[0])
+        if nodes is not None:
+            if isinstance(nodes[-1], dict):
+                return nodes[-1].get(None)
+            return nodes[-1]
+
+    def find(self, pattern):
+        '''
+        A list of (name, entry) for the name, or for every name under the
+        domain if the pattern is *.DOMAIN, in order by reversed labels.
+        '''
+        (labels, under) = self.parse(pattern)
+        if not under:
+            entry = self.get(pattern)
+            return entry and [(pattern.lower().rstrip('.'), entry)] or []
+        nodes = self.path(labels)
+        if nodes is None or not isinstance(nodes[-1], dict):
+            return []
+        return without_gc(self.below, nodes[-1], labels)
+
+    def below(self, node, labels):
+        '''
+        A list of (name, entry) for the names below the node (reached by
+        the reversed labels), in order.
+        '''
+        (found, stack) = ([], [])
+        def push(node, labels):
+            for label in sorted(node, reverse=True):
+                if label is not None:
+                    stack.append((node[label], labels + [label]))
+        push(node, labels)
+        while stack:
+            (node, labels) = stack.pop()
+            name = '.'.join(reversed(labels))
+            if isinstance(node, dict):
+                if None in node:
+                    found.append((name, node[None]))
+                push(node, labels)
+            else:
+                found.append((name, node))
+        return found
+
+    def remove(self, pattern):
+        '''
+        Remove the name (or all the names under the domain, for *.DOMAIN)
+        from the index and from the entries, returning the names removed.
+        '''
+        found = self.find(pattern)
+        if not found:
+            return []
+        for (name, entry) in found:
+            entry.names.remove(name)
+        (labels, under) = self.parse(pattern)
+        nodes = self.path(labels)
+        if under:
+            for label in list(nodes[-1]):
+                if label is not None:
+                    del nodes[-1][label]
+        elif isinstance(nodes[-1], dict):
+            del nodes[-1][None]
+        else:
+            nodes[-1] = {} # an entry, dropped below
+        # drop nodes that no longer lead to any names
+        for depth in range(len(labels), 0, -1):
+            if nodes[depth]:
+                break
+            del nodes[depth-1][labels[depth-1]]
+        return [name for (name, entry) in found]
+
+    def entries(self):
+        '''
+        The entries indexed, in order, without any that have no names left.
+        '''
+        return [entry for entry in self.all if entry._names]
+
+
+def remove_names(patterns, entries):
+    '''
+    Remove the names matching the patterns (see NameIndex) from the 
+    entries, returning the entries that still have names.
+    '''
+    if not patterns:
+        return entries
+    index = NameIndex(entries)
+    for pattern in patterns:
+        index.remove(pattern)
+    return index.entries()
+
+
+class FilterPlan(object):
+    '''
+    The filters for merged entries - names removed (see split_removals()),
+    address ranges (see filter_addresses()) and name patterns (see 
+    remove_names()) - compiled into one plan.  A merge given a plan applies
+    it as it combines the winner for each name, so entries that would be 
+    dropped are not built and their comments are not combined, with the
+    same results as apply(), which filters after the merge.  The age 
+    cut-off is not part of the plan: old entries are dropped by the 
+    sources, before the merge (see skip_older()).
+
+    Entries cannot be dropped before the merge (as they are parsed), 
+    because the result would not be the same: a dropped entry can still
+    win (and so remove) a name that older entries give, and the comments
+    (and date) of a name that is removed are kept by the entry for its
+    address.
+
+    >>> entries = [Entry(ipv4='10.0.0.1', names=['a.com'], 
+    ...                  date=datetime(2010, 1, 2)),
+    ...            Entry(ipv4='1.2.3.4', names=['a.com', 'b.com'], 
+    ...                  date=datetime(2010, 1, 1)),
+    ...            Entry(ipv4='5.6.7.8', names=['www.c.com', 'd.com'], 
+    ...                  comments=['# kept'])]
+    >>> plan = FilterPlan(ranges=['10.0.0.0/8'], patterns=['*.c.com'])
+    >>> merged = merge(entries, plan=plan)
+    >>> sorted(merged, key=lambda entry: entry.ipv4)
+    [<Entry 1.2.3.4:b.com ['## DATE 2010-01-01 00:00:00'] []>, <Entry 5.6.7.8:d.com [] ['# kept']>]
+    >>> map(repr, merged) == map(repr, plan.apply(merge(entries)))
+    True
+    >>> map(repr, merge_external(entries, budget=1000, plan=plan)) == \\
+    ...     map(repr, plan.apply(merge_external(entries, budget=1000)))
+    True
+    '''
+
+    def __init__(self, removals=None, ranges=(), patterns=()):
+        if removals is None:
+            removals = {}
+        if not isinstance(ranges, AddressRanges):
+            ranges = AddressRanges(ranges)
+        (self.removals, self.ranges) = (removals, ranges)
+        self.patterns = list(patterns)
+        (self.names, self.domains) = (set(), set())
+        for pattern in self.patterns: # as NameIndex.parse()
+            pattern = pattern.lower().rstrip('.')
+            if pattern.startswith('*.'):
+                self.domains.add(pattern[2:])
+            else:
+                self.names.add(pattern)
+        # a few domains are matched faster by endswith() than by looking up
+        # each suffix of the name
+        self.suffixes = None
+        if len(self.domains) <= MAX_SUFFIXES:
+            self.suffixes = tuple('.' + domain for domain in self.domains)
+
+    def __nonzero__(self):
+        return bool(self.removals or self.ranges or self.names or 
+                    self.domains)
+
+    def drops(self, ipv4):
+        '''
+        Whether a merged entry with the address (packed, or a string) is
+        dropped.
+        '''
+        if not self.ranges:
+            return False
+        if ipv4.__class__ is int or ipv4.__class__ is long:
+            return self.ranges.contains_packed(ipv4)
+        return ipv4 in self.ranges
+
+    def keeps(self, name, date):
+        '''
+        Whether the name is kept in a merged entry with the date.
+        '''
+        if name in self.removals:
+            removal = self.removals[name]
+            if date is None or (removal is not None and date <= removal):
+                return False
+        if name in self.names:
+            return False
+        if self.suffixes is not None:
+            return not name.endswith(self.suffixes)
+        if self.domains:
+            index = name.find('.')
+            while index >= 0:
+                if name[index + 1:] in self.domains:
+                    return False
+                index = name.find('.', index + 1)
+        return True
+
+    def apply(self, entries, stats=None):
+        '''
+        Filter merged entries (the same as a merge given the plan).
+        '''
+        entries = apply_removals(self.removals, entries)
+        entries = filter_addresses(self.ranges, entries, stats=stats)
+        return remove_names(self.patterns, entries)
@@ -0,0 +1,388 @@
+'''
+Downloading (and caching) sources from the web.
+'''
+
+
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from cPickle import dump, load
+from hashlib import sha1
+from itertools import izip
+from os import remove, fdopen, close, makedirs, listdir, utime
+from os.path import exists, join, getsize, getmtime
+from SocketServer import ThreadingMixIn
+from tempfile import mkstemp, mkdtemp
+from threading import Thread, Lock
+from time import time
+from urllib2 import urlopen, Request, HTTPError
+
+from ghettonet.core import CHUNK, Entry, note_access, replace_file, scan
+from ghettonet.merging import skip_older
+from ghettonet.sources import in_order
+
+
+# headers for downloads (a response with Content-Encoding gzip is stored as
+# it is and decompressed when read, like any other compressed source)
+ACCEPT = {'Accept-Encoding': 'gzip'}
+
+
+def copy_response(source, destination, url, timeout=None, start=None):
+    '''
+    Copy data from the response to the destination file, checking that the
+    total time (since start) does not exceed timeout.
+    '''
+    if start is None:
+        start = time()
+    while True:
+        data = source.read(CHUNK)
+        if not data:
+            break
+        destination.write(data)
+        if timeout is not None and time() - start > timeout:
+            raise Exception('Timeout reading %s' % url)
+    source.close()
+
+
+def fetch_url(url, timeout=None):
+    '''
+    Copy the contents of the given url to a temporary file and return the
+    path.  If timeout is given then the whole download must complete within
+    that many seconds.
+    '''
+    (handle, path) = mkstemp(prefix='ghettonet-')
+    destination = fdopen(handle, 'wb')
+    try:
+        try:
+            start = time()
+            request = Request(url, headers=ACCEPT)
+            copy_response(urlopen(request, timeout=timeout), destination, url,
+                          timeout=timeout, start=start)
+        finally:
+            destination.close()
+    except:
+        remove(path)
+        raise
+    return path
+
+
+def pull_urls(urls, quiet=True, workers=1, timeout=None, stats=None):
+    '''
+    This generates a sequence of local files which contain the contents of
+    the given urls.  The contents should be processed before the next
+    sequence entry is evaluated, as each is deleted in turn.
+
+    Up to "workers" urls are downloaded at once, by separate threads, so
+    that later urls are fetched while earlier ones are processed.  The
+    files are still generated in the original order, and any error is
+    raised when the failing url is reached.
+
+    If stats (a Stats) is given then the time spent waiting for each url
+    (not the time taken by the threads) is recorded as the stage 
+    "pull_urls", with the bytes read.
+    '''
+    urls = list(urls)
+    paths = in_order(lambda url: fetch_url(url, timeout=timeout), urls,
+                     workers=workers, discard=remove)
+    try:
+        for url in urls:
+            note_access(url, quiet)
+            if stats is None:
+                path = paths.next()
+            else:
+                stats.start('pull_urls', url)
+                try:
+                    path = paths.next()
+                finally:
+                    stats.stop()
+                stats.count('pull_urls', url, bytes_read=getsize(path))
+            try:
+                yield path
+            finally:
+                remove(path)
+    finally:
+        paths.close()
+
+
+class UrlCache(object):
+    '''
+    A directory that holds the entries read from URLs, along with the ETag
+    and Last-Modified headers needed to check them with a conditional GET.
+    If the server replies "not modified" then the stored entries are used
+    without downloading or parsing anything.
+
+    Interrupted downloads are kept and, if the server supports it, resumed
+    with a Range request.  When the directory holds more than max_size
+    bytes the least recently used URLs are deleted by evict().
+    '''
+
+    def __init__(self, directory, max_size=None):
+        if not exists(directory):
+            makedirs(directory)
+        self.directory = directory
+        self.max_size = max_size
+        (self.lock, self.locks) = (Lock(), {})
+
+    def path(self, url, suffix):
+        return join(self.directory, sha1(url).hexdigest() + suffix)
+
+    def url_lock(self, url):
+        '''
+        A lock for each url, so that repeated urls are handled in turn.
+        '''
+        self.lock.acquire()
+        try:
+            return self.locks.setdefault(url, Lock())
+        finally:
+            self.lock.release()
+
+    def read_meta(self, url):
+        '''
+        The data stored for the url, or an empty record if missing or 
+        damaged (all errors are ignored as the data can be fetched again).
+        '''
+        try:
+            source = open(self.path(url, '.meta'), 'rb')
+            try:
+                meta = load(source)
+            finally:
+                source.close()
+            if meta.get('url') == url:
+                return meta
+        except:
+            pass
+        return {'url': url}
+
+    def write_meta(self, meta):
+        (handle, path) = mkstemp(dir=self.directory, suffix='.tmp')
+        destination = fdopen(handle, 'wb')
+        try:
+            dump(meta, destination, 2)
+        finally:
+            destination.close()
+        replace_file(path, self.path(meta['url'], '.meta'))
+
+    def fetch(self, url, timeout=None):
+        '''
+        Return (entries, None) if the stored entries are current, or 
+        (None, download) where download must be parsed and passed to 
+        store().  The timeout is as for fetch_url().
+        '''
+        lock = self.url_lock(url)
+        lock.acquire()
+        try:
+            return self.fetch_locked(url, timeout)
+        finally:
+            lock.release()
+
+    def fetch_locked(self, url, timeout, resume=True):
+        start = time()
+        meta = self.read_meta(url)
+        request = Request(url, headers=ACCEPT)
+        if 'entries' in meta:
+            if meta.get('etag'):
+                request.add_header('If-None-Match', meta['etag'])
+            if meta.get('modified'):
+                request.add_header('If-Modified-Since', meta['modified'])
+        part = self.path(url, '.part')
+        offset = 0
+        if resume and meta.get('partial') and exists(part):
+            offset = getsize(part)
+            request.add_header('Range', 'bytes=%d-' % offset)
+            request.add_header('If-Range', meta['partial'])
+        try:
+            response = urlopen(request, timeout=timeout)
+        except HTTPError, error:
+            if error.code == 304 and 'entries' in meta:
+                utime(self.path(url, '.meta'), None) # used recently
+                return (map(Entry.from_tuple, meta['entries']), None)
+            elif error.code == 416 and offset:
+                return self.fetch_locked(url, timeout, resume=False)
+            raise
+        headers = response.info()
+        (etag, modified) = (headers.getheader('ETag'), 
+                            headers.getheader('Last-Modified'))
+        range_ = headers.getheader('Content-Range') or ''
+        if offset and response.code == 206 and \
+                range_.startswith('bytes %d-' % offset):
+            mode = 'ab'
+        else:
+            mode = 'wb'
+        meta['partial'] = etag or modified
+        self.write_meta(meta)
+        destination = open(part, mode)
+        try:
+            copy_response(response, destination, url, 
+                          timeout=timeout, start=start)
+        finally:
+            destination.close()
+        (handle, path) = mkstemp(dir=self.directory, suffix='.new')
+        close(handle)
+        replace_file(part, path)
+        meta['partial'] = None
+        self.write_meta(meta)
+        return (None, (path, etag, modified))
+
+    def store(self, url, download, entries):
+        '''
+        Save the entries parsed from a download returned by fetch().
+        '''
+        (path, etag, modified) = download
+        lock = self.url_lock(url)
+        lock.acquire()
+        try:
+            meta = self.read_meta(url)
+            meta.update(etag=etag, modified=modified, 
+                        entries=[entry.as_tuple() for entry in entries])
+            self.write_meta(meta)
+        finally:
+            lock.release()
+        remove(path)
+
+    def evict(self):
+        '''
+        Delete the least recently used urls until the directory is below
+        max_size bytes.
+        '''
+        if self.max_size is None:
+            return
+        (groups, total) = ({}, 0)
+        for name in listdir(self.directory):
+            path = join(self.directory, name)
+            (key, size) = (name.split('.')[0], getsize(path))
+            group = groups.setdefault(key, [0, 0, []])
+            if name.endswith('.meta') or not group[0]:
+                group[0] = getmtime(path)
+            group[1] = group[1] + size
+            group[2].append(path)
+            total = total + size
+        for (used, size, paths) in sorted(groups.values()):
+            if total <= self.max_size:
+                break
+            for path in paths:
+                remove(path)
+            total = total - size
+
+
+def from_urls(urls, quiet=True, workers=1, timeout=None, cache=None, 
+              stats=None, since=None):
+    '''
+    Generate a sequence of entries from the given URLs.  See pull_urls()
+    for the workers and timeout parameters.  If cache (a UrlCache) is given
+    then unchanged URLs are not downloaded or parsed again (all entries are
+    cached, so with since the older entries are dropped only after 
+    parsing).  If since (a datetime) is given then older entries are 
+    skipped.
+
+    >>> (server, root) = serve_locally({
+    ...     '/a': '### BEGIN GHETTONET\\n1.2.3.4 a.com\\n### END GHETTONET',
+    ...     '/b': '<p>### BEGIN GHETTONET</p>\\n<p>5.6.7.8 b.com</p>'})
+    >>> list(from_urls([root + '/a', root + '/b', root + '/a'], workers=2))
+    [<Entry 1.2.3.4:a.com [] []>, <Entry 5.6.7.8:b.com [] []>, <Entry 1.2.3.4:a.com [] []>]
+    >>> cache = UrlCache(mkdtemp())
+    >>> list(from_urls([root + '/a'], cache=cache))
+    [<Entry 1.2.3.4:a.com [] []>]
+    >>> list(from_urls([root + '/a'], cache=cache))
+    [<Entry 1.2.3.4:a.com [] []>]
+    >>> server.log[-2:]
+    [('/a', 200), ('/a', 304)]
+    >>> server.shutdown()
+    '''
+    urls = list(urls)
+    if cache is None:
+        for (url, path) in izip(urls, pull_urls(urls, quiet=quiet, 
+                                                workers=workers, 
+                                                timeout=timeout, 
+                                                stats=stats)):
+            source = open(path)
+            entries = scan(source, quiet=quiet, stats=stats, name=url,
+                           since=since)
+            if stats is not None:
+                entries = stats.wrap('parse', url, entries)
+            for entry in entries:
+                yield entry
+            source.close()
+    else:
+        def discard(result):
+            if result[1]:
+                remove(result[1][0])
+        results = in_order(lambda url: cache.fetch(url, timeout=timeout), 
+                           urls, workers=workers, discard=discard)
+        try:
+            for url in urls:
+                note_access(url, quiet)
+                if stats is None:
+                    (entries, download) = results.next()
+                else:
+                    stats.start('pull_urls', url)
+                    try:
+                        (entries, download) = results.next()
+                    finally:
+                        stats.stop()
+                    if download:
+                        stats.count('pull_urls', url, 
+                                    bytes_read=getsize(download[0]))
+                    else:
+                        stats.count('pull_urls', url, cache_hits=1)
+                if download:
+                    source = open(download[0])
+                    entries = scan(source, quiet=quiet, stats=stats, name=url)
+                    if stats is not None:
+                        entries = stats.wrap('parse', url, entries)
+                    entries = list(entries)
+                    source.close()
+                    cache.store(url, download, entries)
+                for entry in skip_older(entries, since):
+                    yield entry
+        finally:
+            results.close()
+        cache.evict()
+
+
+def serve_locally(pages):
+    '''
+    Start a web server on a free local port that returns the given pages
+    (a map from path to contents).  This is used in the doctests; call
+    shutdown() on the returned server to stop it.
+
+    The server supports conditional and range requests (using an ETag
+    derived from the contents) and records (path, status) in server.log.
+    '''
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path not in pages:
+                self.send_error(404)
+                self.server.log.append((self.path, 404))
+                return
+            body = pages[self.path]
+            etag = '"%s"' % sha1(body).hexdigest()
+            modified = 'Sat, 04 Dec 2010 00:00:00 GMT'
+            (status, start) = (200, 0)
+            if self.headers.getheader('If-None-Match') == etag or \
+                    self.headers.getheader('If-Modified-Since') == modified:
+                status = 304
+            elif self.headers.getheader('Range') and \
+                    self.headers.getheader('If-Range') in (etag, modified):
+                start = int(self.headers.getheader('Range')[6:-1])
+                status = 206
+            self.server.log.append((self.path, status))
+            self.send_response(status)
+            self.send_header('ETag', etag)
+            self.send_header('Last-Modified', modified)
+            if status == 206:
+                self.send_header('Content-Range', 'bytes %d-%d/%d' % 
+                                 (start, len(body) - 1, len(body)))
+            if status != 304:
+                self.send_header('Content-Length', len(body) - start)
+            self.end_headers()
+            if status != 304:
+                self.wfile.write(body[start:])
+        def log_message(self, format, *args):
+            pass
+    class Server(ThreadingMixIn, HTTPServer):
+        daemon_threads = True
+        request_queue_size = 64
+    server = Server(('127.0.0.1', 0), Handler)
+    server.log = []
+    thread = Thread(target=server.serve_forever)
+    thread.setDaemon(True)
+    thread.start()
+    return (server, 'http://127.0.0.1:%d' % server.server_port)
@@ -0,0 +1,574 @@
+'''
+The sources of entries: the hosts file, local files (possibly in a pool
+of processes), stdin, and reading sources concurrently.
+'''
+
+
+from cPickle import dump, load
+from hashlib import sha1
+from os import fdopen, makedirs, fstat
+from os.path import exists, join, dirname, abspath
+from Queue import Queue
+from sys import stderr, stdin, exc_info
+from tempfile import mkstemp, mkdtemp
+from thread import get_ident
+from threading import Thread, Lock, Event
+
+from ghettonet.core import CHUNK, Entry, PARSED, Scanner, map_file, \
+    note_access, replace_file, scan, set_stderr
+from ghettonet.merging import skip_older, without_gc
+from ghettonet.stats import cpu_time
+from ghettonet.hosts import get_hosts_path, open_hosts
+
+
+def in_order_worker(function, tasks, lock, cancelled, discard):
+    '''
+    The worker thread for in_order().  Each task is an (item, slot) pair;
+    the result, either (value, None) or (None, exc_info), is placed in the
+    slot (a Queue).  If in_order() has finished, values are discarded.
+    '''
+    for (item, slot) in iter(tasks.get, None):
+        try:
+            result = (function(item), None)
+        except:
+            result = (None, exc_info())
+        lock.acquire()
+        try:
+            if not cancelled.isSet():
+                slot.put(result)
+            elif discard and not result[1]:
+                discard(result[0])
+        finally:
+            lock.release()
+
+
+def in_order(function, items, workers=1, discard=None):
+    '''
+    Generate function(item) for each item, in order, while separate threads
+    evaluate up to "workers" items ahead.  Any error is raised when the 
+    failing item is reached.  If the sequence is not completed then values
+    that were already calculated are passed to discard (if given).
+
+    >>> list(in_order(lambda x: x * 2, range(5), workers=3))
+    [0, 2, 4, 6, 8]
+    '''
+    items = list(items)
+    (tasks, pending, threads) = (Queue(), [], [])
+    (lock, cancelled) = (Lock(), Event())
+    workers = max(1, min(workers, len(items)))
+    for count in range(workers):
+        threads.append(Thread(target=in_order_worker,
+                              args=(function, tasks, lock, cancelled, 
+                                    discard)))
+        threads[-1].setDaemon(True)
+        threads[-1].start()
+    def submit(index):
+        if index < len(items):
+            pending.append(Queue(1))
+            tasks.put((items[index], pending[-1]))
+    for index in range(workers):
+        submit(index)
+    try:
+        for index in range(len(items)):
+            (value, error) = pending.pop(0).get()
+            submit(index + workers)
+            if error:
+                raise error[0], error[1], error[2]
+            yield value
+    finally:
+        lock.acquire()
+        try:
+            cancelled.set()
+            for slot in pending:
+                if not slot.empty():
+                    (value, error) = slot.get()
+                    if discard and not error:
+                        discard(value)
+        finally:
+            lock.release()
+        for thread in threads:
+            tasks.put(None)
+        if not pending: # all idle, so wait for a clean exit
+            for thread in threads:
+                thread.join()
+
+
+class ThreadOutput(object):
+    '''
+    A replacement for stderr that keeps what each capturing thread writes,
+    so that it can be printed later, in order.  Other threads write 
+    directly to out.
+    '''
+
+    def __init__(self, out):
+        (self.out, self.buffers) = (out, {})
+
+    def capture(self):
+        self.buffers[get_ident()] = []
+
+    def take(self):
+        '''
+        The text written by this thread since the last call.
+        '''
+        buffer = self.buffers[get_ident()]
+        text = ''.join(buffer)
+        del buffer[:]
+        return text
+
+    def release(self):
+        del self.buffers[get_ident()]
+
+    def write(self, text):
+        buffer = self.buffers.get(get_ident())
+        if buffer is None:
+            self.out.write(text)
+        else:
+            buffer.append(text)
+
+    def flush(self):
+        self.out.flush()
+
+
+def ingest_worker(tasks, cancels, output, batch):
+    '''
+    The worker thread for ingest().  Each task is an (index, entries, slot)
+    triple; the entries, in lists of up to batch, and anything printed to 
+    stderr, are placed in the slot (a bounded Queue) as ('entries', list)
+    and ('text', string), followed by ('done', None) or ('error', 
+    exc_info).  If the source is cancelled then nothing more is placed in 
+    the slot.
+    '''
+    for (index, entries, slot) in iter(tasks.get, None):
+        cancelled = cancels[index]
+        if cancelled.isSet():
+            continue
+        output.capture()
+        try:
+            try:
+                values = []
+                for entry in entries:
+                    values.append(entry)
+                    if len(values) >= batch:
+                        text = output.take()
+                        if text:
+                            slot.put(('text', text))
+                        slot.put(('entries', values))
+                        values = []
+                        if cancelled.isSet():
+                            break
+                else:
+                    text = output.take()
+                    if text:
+                        slot.put(('text', text))
+                    slot.put(('entries', values))
+                    slot.put(('done', None))
+            except:
+                # the remaining sources are not needed, as this error will
+                # end the run when it is reached
+                for later in cancels[index+1:]:
+                    later.set()
+                text = output.take()
+                if text:
+                    slot.put(('text', text))
+                slot.put(('error', exc_info()))
+        finally:
+            output.release()
+            close = getattr(entries, 'close', None)
+            if close:
+                close()
+
+
+def ingest(sources, workers=2, batch=1000, size=8):
+    '''
+    Generate the entries from each source (a sequence of entries) in turn,
+    as chain() does, while separate threads read up to "workers" sources at
+    once, so that a slow URL or pipe does not delay the others.  Each 
+    source runs ahead by at most size lists of batch entries, and anything
+    it prints to stderr is held until the source is reached, so the 
+    results and messages are the same as for chain().  
+
+    Any error is raised when the failing source is reached, and the later
+    sources are then not read, as they are not needed.  Sources must not 
+    share anything that is not thread safe (Stats, for example).
+
+    >>> def source(values, error=None):
+    ...     for value in values:
+    ...         yield value
+    ...     if error:
+    ...         raise error
+    >>> list(ingest([source(range(3)), source([]), source(range(3, 5))],
+    ...             batch=2, size=1))
+    [0, 1, 2, 3, 4]
+    >>> list(ingest([source([1]), source([2], Exception('bad')), 
+    ...              source([3])]))
+    Traceback (most recent call last):
+      ...
+    Exception: bad
+    '''
+    sources = list(sources)
+    (tasks, threads) = (Queue(), [])
+    cancels = [Event() for source in sources]
+    slots = [Queue(size) for source in sources]
+    output = ThreadOutput(stderr)
+    out = set_stderr(output)
+    for (index, source) in enumerate(sources):
+        tasks.put((index, source, slots[index]))
+    for count in range(max(1, min(workers, len(sources)))):
+        threads.append(Thread(target=ingest_worker, 
+                              args=(tasks, cancels, output, batch)))
+        threads[-1].setDaemon(True)
+        threads[-1].start()
+    finished = False
+    try:
+        for slot in slots:
+            while True:
+                (kind, value) = slot.get()
+                if kind == 'entries':
+                    for entry in value:
+                        yield entry
+                elif kind == 'text':
+                    out.write(value)
+                elif kind == 'error':
+                    raise value[0], value[1], value[2]
+                else:
+                    break
+        finished = True
+    finally:
+        set_stderr(out)
+        for cancelled in cancels:
+            cancelled.set()
+        # let any thread waiting on a full slot see that it is cancelled
+        for slot in slots:
+            while not slot.empty():
+                slot.get()
+        for thread in threads:
+            tasks.put(None)
+        if finished: # all idle, so wait for a clean exit
+            for thread in threads:
+                thread.join()
+
+
+def file_key(open_file, data):
+    '''
+    The modification time, size and SHA-1 of an open file, whose contents
+    (a string or mmap) are data.
+    '''
+    status = fstat(open_file.fileno())
+    digest = sha1()
+    for offset in xrange(0, len(data), CHUNK):
+        digest.update(data[offset:offset+CHUNK])
+    return (status.st_mtime, status.st_size, digest.digest())
+
+
+class Snapshot(object):
+    '''
+    The entries parsed from local files, kept in a single file so that 
+    files that have not changed are not parsed again.  Each file is 
+    recorded with its modification time, size and SHA-1, all of which must 
+    match for the stored entries (and any warnings) to be used.  A missing, stale or damaged
+    snapshot is ignored (and replaced by save()).
+
+    >>> from shutil import rmtree
+    >>> directory = mkdtemp()
+    >>> path = join(directory, 'input')
+    >>> open(path, 'w').write('### BEGIN GHETTONET\\n1.2.3.4 a.com\\n')
+    >>> snapshot = Snapshot(join(directory, 'SNAPSHOT'))
+    >>> list(snapshot.scan(open(path), path))
+    [<Entry 1.2.3.4:a.com [] []>]
+    >>> snapshot.save()
+    >>> snapshot = Snapshot(join(directory, 'SNAPSHOT'))
+    >>> list(snapshot.scan(open(path), path))
+    [<Entry 1.2.3.4:a.com [] []>]
+    >>> snapshot.used == [path]
+    True
+    >>> open(join(directory, 'SNAPSHOT'), 'w').write('damaged')
+    >>> list(Snapshot(join(directory, 'SNAPSHOT')).scan(open(path), path))
+    [<Entry 1.2.3.4:a.com [] []>]
+    >>> rmtree(directory)
+    '''
+
+    VERSION = 1
+
+    def __init__(self, path):
+        self.path = path
+        self.records = self.read()
+        self.changed = False
+        self.used = []
+
+    def read(self):
+        '''
+        The stored records, or an empty dict if missing or damaged (all
+        errors are ignored as the files can be parsed again).
+        '''
+        try:
+            source = open(self.path, 'rb')
+            try:
+                snapshot = without_gc(load, source)
+            finally:
+                source.close()
+            if snapshot['version'] == self.VERSION:
+                return snapshot['records']
+        except:
+            pass
+        return {}
+
+    def scan(self, open_file, path, quiet=True, fragile=False, stats=None,
+             since=None):
+        '''
+        Generate the entries in the open file (read from path), as scan()
+        does, but using the stored entries if the file is unchanged.  If
+        stats (a Stats) is given then files that are not parsed again are
+        counted as snapshot_hits.  All entries are stored, so with since
+        the older entries are dropped only after parsing (see 
+        skip_older()).
+        '''
+        data = map_file(open_file)
+        if data is None:
+            for entry in scan(open_file, quiet=quiet, fragile=fragile,
+                              stats=stats, name=path, since=since):
+                yield entry
+            return
+        try:
+            key = file_key(open_file, data)
+            record = self.get(path, key, fragile)
+            if record:
+                for entry in skip_older(self.replay(path, record, quiet),
+                                        since):
+                    yield entry
+                if stats is not None:
+                    stats.count('parse', path, bytes_read=len(data),
+                                snapshot_hits=1)
+            else:
+                (scanner, entries) = (Scanner(quiet, fragile, PARSED), [])
+                for entry in scanner.scan_data(data, key[2]):
+                    entries.append(entry.as_tuple())
+                    if since is None or entry.date is None or \
+                            entry.date >= since:
+                        yield entry
+                scanner.close()
+                self.put(path, (key, entries, scanner.messages), fragile)
+                if stats is not None:
+                    stats.count('parse', path, **scanner.counts(data))
+        finally:
+            data.close()
+
+    def get(self, path, key=None, fragile=False):
+        '''
+        The (key, entries, messages) stored for path, or None.  If key is
+        given then it must match.
+        '''
+        record = self.records.get((abspath(path), fragile))
+        if record and (key is None or record[0] == key):
+            return record
+
+    def put(self, path, record, fragile=False):
+        self.records[(abspath(path), fragile)] = record
+        self.changed = True
+
+    def replay(self, path, record, quiet=True):
+        '''
+        Generate the stored entries, printing any stored warnings.
+        '''
+        self.used.append(path)
+        for entry in record[1]:
+            yield Entry.from_tuple(entry)
+        if not quiet:
+            for message in record[2]:
+                print >> stderr, message
+
+    def save(self, quiet=True):
+        '''
+        Write the records (if changed), dropping any for deleted files.
+        '''
+        if not self.changed:
+            return
+        for name in list(self.records):
+            if not exists(name[0]):
+                del self.records[name]
+        try:
+            directory = dirname(self.path) or '.'
+            if not exists(directory):
+                makedirs(directory)
+            (handle, path) = mkstemp(dir=directory, suffix='.tmp')
+            destination = fdopen(handle, 'wb')
+            try:
+                dump({'version': self.VERSION, 'records': self.records},
+                     destination, 2)
+            finally:
+                destination.close()
+            replace_file(path, self.path)
+            self.changed = False
+        except EnvironmentError, error:
+            if not quiet:
+                print >> stderr, 'Could not save %s: %s' % (self.path, error)
+
+
+def from_hosts(path=None, exclude=False, quiet=True, snapshot=None, 
+               stats=None):
+    '''
+    Generate a sequence of entries from the local hosts file.  If snapshot
+    (a Snapshot) is given then an unchanged file is not parsed again.  If
+    stats (a Stats) is given then parsing is recorded (as for all the 
+    "from_" routines that read data).
+    '''
+    if not exclude:
+        hosts = open_hosts(path=path, quiet=quiet)
+        path = get_hosts_path(path)
+        if snapshot is None:
+            entries = scan(hosts, quiet=quiet, fragile=True, stats=stats,
+                           name=path)
+        else:
+            entries = snapshot.scan(hosts, path, quiet=quiet, fragile=True,
+                                    stats=stats)
+        if stats is not None:
+            entries = stats.wrap('parse', path, entries)
+        for entry in entries:
+            yield entry
+        hosts.close()
+
+
+def from_paths(paths, quiet=True, snapshot=None, processes=1, stats=None,
+               since=None):
+    '''
+    Generate a sequence of entries from the given files.  If snapshot (a
+    Snapshot) is given then unchanged files are not parsed again.  If
+    since (a datetime) is given then older entries are skipped.
+
+    If processes is more than one then files are parsed in a pool of that
+    many processes (see scan_path()).  The entries, and any warnings, are
+    still given in the same order.
+
+    >>> from shutil import rmtree
+    >>> directory = mkdtemp()
+    >>> paths = [join(directory, name) for name in 'abc']
+    >>> for (index, path) in enumerate(paths):
+    ...     open(path, 'w').write('### BEGIN GHETTONET\\n'
+    ...                           '1.2.3.%d %s.com\\n' % (index, path[-1]))
+    >>> list(from_paths(paths, processes=2))
+    [<Entry 1.2.3.0:a.com [] []>, <Entry 1.2.3.1:b.com [] []>, <Entry 1.2.3.2:c.com [] []>]
+    >>> rmtree(directory)
+    '''
+    if processes > 1 and len(paths) > 1:
+        entries = from_paths_in_pool(paths, quiet=quiet, snapshot=snapshot, 
+                                     processes=processes, stats=stats)
+        for entry in skip_older(entries, since):
+            yield entry
+        return
+    for path in paths:
+        note_access(path, quiet=quiet)
+        source = open(path)
+        if snapshot is None:
+            entries = scan(source, quiet=quiet, stats=stats, name=path,
+                           since=since)
+        else:
+            entries = snapshot.scan(source, path, quiet=quiet, stats=stats,
+                                    since=since)
+        if stats is not None:
+            entries = stats.wrap('parse', path, entries)
+        for entry in entries:
+            yield entry
+        source.close()
+
+
+def scan_path(job):
+    '''
+    Parse the file at path, for from_paths_in_pool(), returning (key, 
+    entries, messages, counts) where key is from file_key() (None if the
+    file could not be mapped), entries are from Entry.as_tuple(), and 
+    messages are the warnings.  If the key is equal to known then entries
+    is None.  If counting is True then counts are for Stats (including the
+    CPU time used in this process); otherwise they are None.
+    '''
+    (path, known, counting) = job
+    cpu = cpu_time()
+    source = open(path)
+    try:
+        data = map_file(source)
+        if data is None:
+            (key, data) = (None, source.read())
+        else:
+            key = file_key(source, data)
+        try:
+            if key is not None and key == known:
+                counts = None
+                if counting:
+                    counts = {'bytes_read': len(data), 'snapshot_hits': 1,
+                              'cpu': cpu_time() - cpu}
+                return (key, None, [], counts)
+            scanner = Scanner(cache=PARSED)
+            entries = [entry.as_tuple() 
+                       for entry in scanner.scan_data(data, key and key[2])]
+            scanner.close()
+            counts = None
+            if counting:
+                counts = scanner.counts(data)
+                counts['cpu'] = cpu_time() - cpu
+            return (key, entries, scanner.messages, counts)
+        finally:
+            if key is not None:
+                data.close()
+    finally:
+        source.close()
+
+
+def from_paths_in_pool(paths, quiet=True, snapshot=None, processes=2, 
+                       stats=None):
+    '''
+    Parse files in a pool of processes, giving the same results, in the same
+    order, as from_paths().  With stats, the time recorded for parsing each
+    file is the time spent waiting for it, plus the CPU time of the worker.
+    '''
+    from multiprocessing import Pool # slow to import, and rarely needed
+    jobs = []
+    for path in paths:
+        record = snapshot and snapshot.get(path)
+        jobs.append((path, record and record[0], stats is not None))
+    pool = Pool(processes)
+    try:
+        results = pool.imap(scan_path, jobs, 1)
+        for (path, known, counting) in jobs:
+            note_access(path, quiet=quiet)
+            if stats is not None:
+                stats.start('parse', path)
+            try:
+                (key, entries, messages, counts) = results.next()
+            finally:
+                if stats is not None:
+                    stats.stop()
+            if entries is None:
+                record = snapshot.get(path)
+                if stats is not None:
+                    stats.count('parse', path, entries=len(record[1]), 
+                                **counts)
+                for entry in snapshot.replay(path, record, quiet):
+                    yield entry
+            else:
+                if stats is not None:
+                    stats.count('parse', path, entries=len(entries), 
+                                **counts)
+                for entry in entries:
+                    yield Entry.from_tuple(entry)
+                if not quiet:
+                    for message in messages:
+                        print >> stderr, message
+                if snapshot is not None and key is not None:
+                    snapshot.put(path, (key, entries, messages))
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def from_stdin(include, quiet=True, stats=None, since=None):
+    '''
+    Generate a sequence of entries from stding.  If since (a datetime) is
+    given then older entries are skipped.
+    '''
+    if include:
+        note_access('the command line (stdin)', quiet=quiet)
+        entries = scan(stdin, quiet=quiet, stats=stats, name='stdin',
+                       since=since)
+        if stats is not None:
+            entries = stats.wrap('parse', 'stdin', entries)
+        for entry in entries:
+            yield entry
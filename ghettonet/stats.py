@@ -0,0 +1,205 @@
+'''
+Statistics on a run (see --stats).
+'''
+
+
+from cStringIO import StringIO
+from json import dump as dump_json
+from os import times
+from platform import system
+from sys import stderr
+from time import time
+
+try:
+    from resource import getrusage, RUSAGE_SELF
+except ImportError: # not available on Windows
+    getrusage = None
+
+
+def cpu_time():
+    '''
+    The user and system CPU time used by this process, in seconds.
+    '''
+    return sum(times()[:2])
+
+
+def peak_memory():
+    '''
+    The peak memory used by this process, in kB, or None if not known.
+    '''
+    if getrusage is None:
+        return None
+    peak = getrusage(RUSAGE_SELF).ru_maxrss
+    if system() == 'Darwin': # reported in bytes
+        peak = peak // 1024
+    return peak
+
+
+class Stats(object):
+    '''
+    Times and counts for the stages of a run (parse, pull_urls, merge, 
+    filter_addresses, write and update_hosts, plus any merge_names 
+    functions), by source (a file or URL, or None for stages that handle
+    all the entries).  The routines that take a stats argument record their
+    work here; when it is None (the default) nothing is recorded and there
+    is no extra work for each line or entry.
+
+    Stages are timed with start() and stop(), or wrap() for a sequence,
+    and these nest: the time recorded for a stage excludes the stages 
+    within it (so reading a file while merging is counted as parsing).
+    Wall and CPU time are recorded, with the peak memory used by the 
+    process when the stage ends.  Other values are added with count().
+    Each hook (a function taking the stage, source and a dict of values)
+    is called for every addition, so that a run can be followed as it 
+    happens.
+
+    >>> from ghettonet.core import scan
+    >>> from ghettonet.merging import merge
+    >>> stats = Stats()
+    >>> data = StringIO('### BEGIN GHETTONET\\n1.2.3.4 a.com\\n'
+    ...                 '1.2.3.4 b.com\\n')
+    >>> entries = stats.wrap('parse', 'data', 
+    ...                      scan(data, stats=stats, name='data'))
+    >>> merge(entries, stats=stats)
+    [<Entry 1.2.3.4:a.com;b.com [] []>]
+    >>> parsed = stats.records[('parse', 'data')]
+    >>> parsed['entries'], parsed['lines'], parsed['blocks']
+    (2, 3, 1)
+    >>> stats.records[('merge', None)]['entries']
+    1
+    '''
+
+    # values that are not simple counts
+    TIMES = ('wall', 'cpu', 'peak_kb')
+
+    def __init__(self, hooks=None):
+        self.records = {}
+        self.order = []
+        self.hooks = list(hooks or [])
+        self.running = []
+        self.started = (time(), cpu_time())
+
+    def count(self, stage, source=None, **values):
+        '''
+        Add the values to those for the stage and source (except peak_kb,
+        where the largest value is kept).
+        '''
+        key = (stage, source)
+        record = self.records.get(key)
+        if record is None:
+            record = self.records[key] = {}
+            self.order.append(key)
+        for (name, value) in values.iteritems():
+            if value is None:
+                continue
+            elif name == 'peak_kb':
+                record[name] = max(record.get(name, 0), value)
+            else:
+                record[name] = record.get(name, 0) + value
+        for hook in self.hooks:
+            hook(stage, source, values)
+
+    def start(self, stage, source=None):
+        '''
+        Start timing the stage for the source, within any stage that is 
+        already running.
+        '''
+        self.running.append([stage, source, time(), cpu_time(), 0, 0])
+
+    def pop(self):
+        '''
+        Finish the most recently started stage, returning (stage, source, 
+        wall, cpu) with the times for any nested stages excluded.
+        '''
+        (stage, source, wall, cpu, nested_wall, nested_cpu) = \
+            self.running.pop()
+        (wall, cpu) = (time() - wall, cpu_time() - cpu)
+        if self.running:
+            outer = self.running[-1]
+            (outer[4], outer[5]) = (outer[4] + wall, outer[5] + cpu)
+        return (stage, source, wall - nested_wall, cpu - nested_cpu)
+
+    def stop(self):
+        '''
+        Stop timing the most recently started stage, recording the times.
+        '''
+        (stage, source, wall, cpu) = self.pop()
+        self.count(stage, source, wall=wall, cpu=cpu, peak_kb=peak_memory())
+
+    def wrap(self, stage, source, entries):
+        '''
+        Generate the entries, recording the time spent producing them (but
+        not the time spent by the caller) as the stage, with the number of
+        entries.
+        '''
+        (entries, count, wall, cpu) = (iter(entries), 0, 0, 0)
+        try:
+            while True:
+                self.start(stage, source)
+                try:
+                    entry = entries.next()
+                except StopIteration:
+                    return
+                finally:
+                    (elapsed, used) = self.pop()[2:]
+                    (wall, cpu) = (wall + elapsed, cpu + used)
+                count = count + 1
+                yield entry
+        finally:
+            self.count(stage, source, wall=wall, cpu=cpu, entries=count,
+                       peak_kb=peak_memory())
+
+    def timed(self, function):
+        '''
+        Wrap a merge_names function so that it is recorded as a stage
+        (named after the function), with the number of entries removed.
+        '''
+        def timed(entries, quiet):
+            self.start(function.__name__)
+            try:
+                merged = function(entries, quiet)
+            finally:
+                self.stop()
+            self.count(function.__name__, removed=len(entries) - len(merged))
+            return merged
+        return timed
+
+    def rows(self):
+        '''
+        Generate a dict of values, including stage and source, for each
+        stage and source in the order first seen, then for the total.
+        '''
+        for (stage, source) in self.order:
+            row = dict(self.records[(stage, source)])
+            (row['stage'], row['source']) = (stage, source)
+            yield row
+        yield {'stage': 'total', 'source': None, 
+               'wall': time() - self.started[0],
+               'cpu': cpu_time() - self.started[1], 
+               'peak_kb': peak_memory()}
+
+    def report(self, out=stderr):
+        '''
+        Print a summary, with a line for each stage and source.
+        '''
+        print >> out, '%-16s %9s %9s %9s  %s' % \
+            ('stage', 'wall (s)', 'cpu (s)', 'peak (MB)', 'source: counts')
+        for row in self.rows():
+            peak = '-'
+            if row.get('peak_kb') is not None:
+                peak = '%.1f' % (row['peak_kb'] / 1024.0)
+            counts = ' '.join('%s=%d' % (name, row[name]) 
+                              for name in sorted(row) 
+                              if name not in self.TIMES + ('stage', 'source'))
+            if row['source'] is not None:
+                counts = '%s: %s' % (row['source'], counts)
+            print >> out, '%-16s %9.3f %9.3f %9s  %s' % \
+                (row['stage'], row.get('wall', 0), row.get('cpu', 0), peak,
+                 counts)
+
+    def report_json(self, out):
+        '''
+        Write the values as a JSON list of objects (see rows()).
+        '''
+        dump_json(list(self.rows()), out, sort_keys=True, indent=1)
+        print >> out
@@ -0,0 +1,300 @@
+'''
+Watching sources for changes and updating the hosts file (see --watch).
+'''
+
+
+from ctypes import CDLL
+from ctypes.util import find_library
+from itertools import chain
+from os import close, stat, read
+from os.path import join, dirname, abspath
+from select import select
+from sys import stderr
+from tempfile import mkdtemp
+from time import time, sleep
+
+from ghettonet.merging import AddressRanges, FilterPlan, merge, \
+    split_removals
+from ghettonet.hosts import BackupStore, get_hosts_path, update_hosts
+from ghettonet.sources import from_hosts, from_paths
+from ghettonet.network import from_urls
+
+
+# inotify events for a changed file in a watched directory (IN_ATTRIB,
+# IN_CLOSE_WRITE, IN_MOVED_FROM, IN_MOVED_TO, IN_CREATE and IN_DELETE)
+INOTIFY_MASK = 0x4 | 0x8 | 0x40 | 0x80 | 0x100 | 0x200
+
+
+def file_state(path):
+    '''
+    The modification time, size and inode of the file at path (None if it
+    does not exist), which change when the file is changed.
+    '''
+    try:
+        status = stat(path)
+    except EnvironmentError:
+        return None
+    return (status.st_mtime, status.st_size, status.st_ino)
+
+
+def watch_directories(directories):
+    '''
+    Return a file descriptor that becomes readable when a file in any of
+    the directories changes, or None if that is not possible (this uses
+    inotify, so is only available on Linux).
+    '''
+    try:
+        libc = CDLL(find_library('c') or 'libc.so.6', use_errno=True)
+        events = libc.inotify_init()
+    except (EnvironmentError, AttributeError):
+        return None
+    if events < 0:
+        return None
+    for directory in directories:
+        if libc.inotify_add_watch(events, directory, INOTIFY_MASK) < 0:
+            close(events)
+            return None
+    return events
+
+
+class Watcher(object):
+    '''
+    A long-running alternative to updating the hosts file from cron: the
+    entries from each source are kept in memory and the hosts file is
+    updated whenever a source changes.
+
+    Local files (the inputs and the hosts file) are watched with inotify
+    where possible and otherwise checked every poll seconds; a file has
+    changed when its modification time, size or inode changes.  Once there
+    have been no further changes for settle seconds (so that a burst of 
+    changes gives a single update) the changed sources are read again and
+    all the entries are merged and written.  The input files are read 
+    together, as from_paths() reads them for a single run (so with a 
+    snapshot only the changed files are parsed).  URLs are read again 
+    every refresh seconds.  After the initial update, errors (a bad file,
+    a failed download, a conflict) are reported and the previous entries 
+    kept.
+
+    The remaining arguments (since, snapshot, processes, budget and so on)
+    are those of a single run, so that the hosts file is written as it 
+    would be by running again (see source_options() in ghettonet.cli).
+
+    The hosts file is both a source and the destination.  After an update
+    the entries written replace those read from the hosts file (as if it
+    had been read again), and the write itself is not seen as a change.
+
+    >>> from shutil import rmtree
+    >>> directory = mkdtemp()
+    >>> (hosts, path) = (join(directory, 'hosts'), join(directory, 'input'))
+    >>> open(hosts, 'w').write('127.0.0.1 localhost\\n')
+    >>> open(path, 'w').write('### BEGIN GHETTONET\\n1.2.3.4 a.com\\n')
+    >>> watcher = Watcher([path], hosts_path=hosts, 
+    ...                   backups=BackupStore(join(directory, 'backups')))
+    >>> watcher.start()
+    >>> 'a.com' in open(hosts).read()
+    True
+    >>> open(path, 'w').write('### BEGIN GHETTONET\\n5.6.7.8 b.com\\n')
+    >>> watcher.step()
+    >>> 'b.com' in open(hosts).read()
+    True
+    >>> watcher.close()
+
+    The filters and source options can be given as the command line gives
+    them:
+
+    >>> from ghettonet.cli import build_parser, plan_options, source_options
+    >>> open(path, 'w').write('### BEGIN GHETTONET\\n5.6.7.8 b.com\\n'
+    ...                       '## DATE 2000-01-01\\n1.2.3.4 c.com\\n')
+    >>> (options, args) = build_parser().parse_args(
+    ...     ['-q', '-r', '5.6.7.0/24', '--since', '2010-01-01'])
+    >>> plan = plan_options(options)
+    >>> watcher = Watcher([path], hosts_path=hosts, remove=plan.ranges,
+    ...                   remove_names=plan.patterns, 
+    ...                   **source_options(options))
+    >>> watcher.start()
+    >>> 'b.com' in open(hosts).read(), 'c.com' in open(hosts).read()
+    (False, False)
+    >>> watcher.close()
+    >>> rmtree(directory)
+    '''
+
+    def __init__(self, paths=(), urls=(), hosts_path=None, exclude=False,
+                 remove=(), remove_names=(), extra=(), quiet=True, 
+                 backups=None, 
+                 timeout=None, cache=None, refresh=600, poll=1, 
+                 settle=0.2, layout=None, since=None, snapshot=None, 
+                 processes=1, budget=None):
+        self.hosts_path = get_hosts_path(path=hosts_path)
+        (self.paths, self.urls) = (list(paths), list(urls))
+        if not isinstance(remove, AddressRanges):
+            remove = AddressRanges(remove)
+        (self.exclude, self.remove) = (exclude, remove)
+        self.remove_names = list(remove_names)
+        (self.quiet, self.backups) = (quiet, backups)
+        (self.timeout, self.cache) = (timeout, cache)
+        (self.refresh, self.poll, self.settle) = (refresh, poll, settle)
+        (self.layout, self.since, self.snapshot) = (layout, since, snapshot)
+        (self.processes, self.budget) = (processes, budget)
+        # the sources, in the order they are merged
+        self.sources = [('extra', None)]
+        if not exclude:
+            self.sources.append(('hosts', self.hosts_path))
+        if self.paths:
+            self.sources.append(('paths', None))
+        self.sources.extend(('url', url) for url in self.urls)
+        self.entries = {('extra', None): list(extra)}
+        self.states = {}
+        (self.events, self.refreshed) = (None, None)
+
+    def start(self):
+        '''
+        Read all the sources and update the hosts file.  Any error is 
+        raised.
+        '''
+        files = [self.hosts_path] + self.paths
+        self.events = watch_directories(
+            set(dirname(abspath(path)) for path in files))
+        for path in files:
+            self.states[path] = file_state(path)
+        for source in self.sources[1:]:
+            self.read(source, fatal=True)
+        self.refreshed = time()
+        self.update(fatal=True)
+        if self.snapshot is not None:
+            self.snapshot.save(quiet=self.quiet)
+
+    def run(self):
+        '''
+        Start, then update the hosts file as the sources change (until 
+        interrupted).
+        '''
+        self.start()
+        try:
+            while True:
+                self.step()
+        finally:
+            self.close()
+
+    def step(self):
+        '''
+        Wait until a file has changed, or the URLs are due to be read, and
+        then update the hosts file.
+        '''
+        changed = self.changed()
+        while not changed and not self.due():
+            self.wait()
+            changed = self.changed()
+        while changed:
+            sleep(self.settle)
+            self.drain()
+            more = self.changed()
+            if not more:
+                break
+            changed.update(more)
+        if self.due():
+            for url in self.urls:
+                self.read(('url', url))
+            self.refreshed = time()
+        if self.hosts_path in changed and not self.exclude:
+            self.read(('hosts', self.hosts_path))
+        if changed.intersection(self.paths):
+            self.read(('paths', None))
+        self.update()
+        if self.snapshot is not None:
+            self.snapshot.save(quiet=self.quiet)
+
+    def close(self):
+        if self.events is not None:
+            close(self.events)
+            self.events = None
+
+    def changed(self):
+        '''
+        The set of files that have changed since last checked.
+        '''
+        changed = set()
+        for path in self.states:
+            state = file_state(path)
+            if state != self.states[path]:
+                self.states[path] = state
+                changed.add(path)
+        return changed
+
+    def due(self):
+        return self.urls and time() >= self.refreshed + self.refresh
+
+    def wait(self):
+        '''
+        Wait for a change to a watched directory (or for poll seconds if 
+        they cannot be watched), or until the URLs are due.
+        '''
+        timeout = None
+        if self.urls:
+            timeout = max(0, self.refreshed + self.refresh - time())
+        if self.events is None:
+            if timeout is None:
+                timeout = self.poll
+            sleep(min(timeout, self.poll))
+        elif select([self.events], [], [], timeout)[0]:
+            self.drain()
+
+    def drain(self):
+        '''
+        Discard any pending inotify events.
+        '''
+        while self.events is not None and \
+                select([self.events], [], [], 0)[0]:
+            read(self.events, 65536)
+
+    def read(self, source, fatal=False):
+        '''
+        Read the entries for a source (a (kind, name) pair).  On error, if 
+        fatal is False, the error is reported and the previous entries are
+        kept.
+        '''
+        (kind, name) = source
+        try:
+            if kind == 'hosts':
+                entries = from_hosts(path=name, quiet=self.quiet, 
+                                     snapshot=self.snapshot)
+            elif kind == 'paths':
+                name = ', '.join(self.paths)
+                entries = from_paths(self.paths, quiet=self.quiet,
+                                     snapshot=self.snapshot, 
+                                     processes=self.processes, 
+                                     since=self.since)
+            else:
+                entries = from_urls([name], quiet=self.quiet, 
+                                    timeout=self.timeout, cache=self.cache,
+                                    since=self.since)
+            self.entries[source] = list(entries)
+        except Exception, error:
+            if fatal:
+                raise
+            print >> stderr, 'WARNING: Could not read %s (%s)' % (name, error)
+
+    def update(self, fatal=False):
+        '''
+        Merge the entries from all sources and write them to the hosts 
+        file.  On error, if fatal is False, the error is reported and the
+        hosts file is not changed.
+        '''
+        entries = chain(*[self.entries.get(source, []) 
+                          for source in self.sources])
+        try:
+            plan = FilterPlan(ranges=self.remove, patterns=self.remove_names)
+            entries = list(merge(split_removals(entries, plan.removals), 
+                                 quiet=self.quiet, budget=self.budget, 
+                                 plan=plan))
+            update_hosts(entries, erase=self.exclude, 
+                         hosts_path=self.hosts_path, quiet=self.quiet, 
+                         backups=self.backups, layout=self.layout)
+        except Exception, error:
+            if fatal:
+                raise
+            print >> stderr, 'WARNING: Could not update %s (%s)' % \
+                (self.hosts_path, error)
+            return
+        if not self.exclude:
+            self.entries[('hosts', self.hosts_path)] = entries
+        self.states[self.hosts_path] = file_state(self.hosts_path)